@@ -1,56 +1,560 @@
-from typing import List, Tuple, Dict, Union
+from typing import Callable, List, Tuple, Dict, Union
 import logging
+import os
+import queue
+import re
+import shutil
+import threading
 import time
 
 import chess.pgn
 import chess.engine
 
+from engine_ensemble import EngineEnsemble, quit_engine
+from eval_cache import EvalCache, engine_identity, limit_key
+from metrics import METRICS, log_progress
+
 logger = logging.getLogger(__name__)
 
+# set once every position of a game is analyzed, so a restarted run can skip the game
+ANALYSIS_TIME_HEADER = 'AnalysisTime'
+# prefixes the header's value when AdaptiveAnalysis only spent analysis_time on some positions, ie: "adaptive:0.25"
+ADAPTIVE_ANALYSIS_PREFIX = 'adaptive:'
+EVAL_REGEX = re.compile(r"\[%eval\s[^\]]*\]")
+# the limit a local eval was analysed with, ie: "[%eval 0.41] [%evallimit time=0.25]", lichess' evals don't have it
+EVAL_LIMIT_REGEX = re.compile(r"\s?\[%evallimit\s([^\]]*)\]")
+_LIMIT_FIELDS = ('time', 'depth', 'nodes')
+# set on games whose evals came from lichess' server analysis when converting them
+SERVER_ANALYSIS_HEADER = 'ServerAnalysis'
+DEPTH_BUCKETS = (1, 2, 4, 6, 8, 10, 12, 14, 16, 18, 20, 25, 30, 40, 50)
+
 
-def get_score(board, engine, analysis_time=0.1) -> Tuple[str, chess.engine.Score]:
-    info = engine.analyse(board, chess.engine.Limit(time=analysis_time))
+def analyse_position(board, engine, limit: chess.engine.Limit, cache: EvalCache = None,
+                     game_key: object = None) -> Tuple[chess.engine.Score, str]:
+    """
+    :param game_key: positions analysed with the same key are treated as one game by the engine, which keeps its
+        hash between them, a different key than the previous call sends `ucinewgame` first
+    :return: the score from white's point of view and any extra comment the engine gives
+        (ie: an EngineEnsemble's per engine scores), the extra comment is empty when the score comes from the cache
+    """
+    if cache is not None:
+        key = limit_key(limit, get_engine_identity(engine, cache))
+        score_from_white = cache.get(board, key)
+        if score_from_white is not None:
+            return score_from_white, ""
+    with METRICS.timer('engine_latency_seconds'):
+        info = engine.analyse(board, limit, game=game_key)
+    _record_engine_info(info)
     pov_score: chess.engine.PovScore = info['score']
     score_from_white: chess.engine.Score = pov_score.pov(chess.WHITE)
+    if cache is not None:
+        cache.put(board, key, score_from_white)
+    return score_from_white, info.get('comment', "")
+
+
+def get_engine_identity(engine, cache: EvalCache = None) -> str:
+    """
+    how the eval cache's keys name the engine, see eval_cache.engine_identity
+    a LazyEngine reads it from the cache when it can, instead of starting the engine
+    """
+    if isinstance(engine, LazyEngine):
+        return engine.get_identity(cache)
+    # engines that didn't come from open_engine don't say which options they were given
+    return getattr(engine, 'eval_cache_identity', None) or engine.id.get('name', '')
+
+
+def _record_engine_info(info: dict):
+    # an EngineEnsemble reports every engine's info, its nodes add up and its depth is the shallowest one
+    infos = info.get('infos', [info])
+    METRICS.inc('engine_positions_total')
+    METRICS.inc('engine_nodes_total', sum(engine_info.get('nodes', 0) for engine_info in infos))
+    depths = [engine_info['depth'] for engine_info in infos if 'depth' in engine_info]
+    if depths:
+        METRICS.observe('engine_depth', min(depths), buckets=DEPTH_BUCKETS)
+
+
+def get_score(board, engine, analysis_time=0.1, cache: EvalCache = None,
+              limit: chess.engine.Limit = None) -> Tuple[str, chess.engine.Score]:
+    """
+    :param limit: overrides analysis_time, ie: chess.engine.Limit(depth=8) for a quick first pass
+    """
+    if limit is None:
+        limit = chess.engine.Limit(time=analysis_time)
+    score_from_white, _ = analyse_position(board, engine, limit, cache=cache)
+    return format_score(score_from_white), score_from_white
+
+
+def format_score(score_from_white: chess.engine.Score) -> str:
     if isinstance(score_from_white, chess.engine.Cp):
         # in centipawn, so +41 becomes 0.41
         s = score_from_white.score() / 100.
-        return f"+{s}" if s > 0.0 else str(s), score_from_white
-    return str(score_from_white), score_from_white  # otherwise its mate or mate is already given
+        return f"+{s}" if s > 0.0 else str(s)
+    return str(score_from_white)  # otherwise its mate or mate is already given
+
+
+def format_limit(limit: chess.engine.Limit) -> str:
+    return ','.join(f'{field}={getattr(limit, field)}' for field in _LIMIT_FIELDS if getattr(limit, field) is not None)
+
+
+def parse_limit(limit_str: str) -> chess.engine.Limit:
+    fields = dict(field.split('=', 1) for field in limit_str.split(',') if '=' in field)
+    return chess.engine.Limit(
+        time=float(fields['time']) if 'time' in fields else None,
+        depth=int(fields['depth']) if 'depth' in fields else None,
+        nodes=int(fields['nodes']) if 'nodes' in fields else None
+    )
+
+
+def eval_meets_limit(comment: str, limit: chess.engine.Limit, server_analysis: bool) -> bool:
+    """
+    whether the comment has an eval analysed at least as long or as deep as limit on every field limit sets
+    lichess' server evals don't say how deep they are and are taken as deep enough, local evals without their limit
+    (written before it was recorded) aren't
+    :param server_analysis: whether the game has lichess' server analysis, see has_server_analysis
+    """
+    if not EVAL_REGEX.search(comment):
+        return False
+    match = EVAL_LIMIT_REGEX.search(comment)
+    if match is None:
+        return server_analysis
+    recorded = parse_limit(match.group(1))
+    for field in _LIMIT_FIELDS:
+        wanted = getattr(limit, field)
+        if wanted is not None and (getattr(recorded, field) is None or getattr(recorded, field) < wanted):
+            return False
+    return True
+
+
+def strip_eval(comment: str) -> str:
+    return EVAL_LIMIT_REGEX.sub("", EVAL_REGEX.sub("", comment))
+
+
+def add_eval_comment(node: chess.pgn.GameNode, score: str, actual_eval: chess.engine.Score, extra_comment: str = "",
+                     limit: chess.engine.Limit = None):
+    """
+    :param limit: what the eval was analysed with, recorded so a later analysis asking for more re-analyses it
+    """
+    node.comment += f'[%eval {score}]'
+    if limit is not None:
+        node.comment += f' [%evallimit {format_limit(limit)}]'
+    if extra_comment:
+        node.comment += f' {extra_comment}'
+    if node.eval().pov(chess.WHITE) != actual_eval:
+        # assert not rounding error
+        assert abs(node.eval().pov(chess.WHITE).score() - actual_eval.score()) == 1, \
+            f"eval's not equal, not rounding error: {node.eval().pov(chess.WHITE)} != {actual_eval}"
+
+
+def get_analysis_header_value(analysis_time, adaptive: bool = False) -> str:
+    return f"{ADAPTIVE_ANALYSIS_PREFIX}{analysis_time}" if adaptive else str(analysis_time)
+
+
+def is_analysis_header_done(header_value: Union[str, None], analysis_time, adaptive: bool = False) -> bool:
+    """
+    a game analyzed in full with analysis_time is done for an adaptive analysis too, but not the other way around
+    """
+    return header_value == str(analysis_time) or \
+        (adaptive and header_value == get_analysis_header_value(analysis_time, adaptive=True))
+
+
+def is_game_analyzed(game: chess.pgn.Game, analysis_time, adaptive: bool = False) -> bool:
+    return is_analysis_header_done(game.headers.get(ANALYSIS_TIME_HEADER), analysis_time, adaptive)
+
+
+def has_server_analysis(game: chess.pgn.Game) -> bool:
+    return SERVER_ANALYSIS_HEADER in game.headers
+
+
+def _first_node_to_analyze(game: chess.pgn.Game) -> chess.pgn.GameNode:
+    # lichess never evaluates the starting position and nothing reads its eval, so it isn't worth an engine call
+    if has_server_analysis(game) and len(game.variations):
+        return game.variations[0]
+    return game
+
+
+class LazyEvalProvider:
+    """
+    analyses positions only when an analysis_utils query asks for their eval, ie:
+    `get_first_move_with_bad_move(game, player, eval_provider=LazyEvalProvider(engine, 0.25, cache=EvalCache()))`
+    evals are memoized per position, kept in the cache across runs and written to the game (unless annotate is
+    False) so saving the game keeps them too, the game isn't marked as analyzed since only some positions are
+    """
+    def __init__(self, engine: chess.engine.SimpleEngine, analysis_time: float = None,
+                 limit: chess.engine.Limit = None, cache: EvalCache = None, annotate: bool = True):
+        """
+        :param limit: overrides analysis_time
+        """
+        self.engine = engine
+        self.limit = limit if limit is not None else chess.engine.Limit(time=analysis_time)
+        self.cache = cache
+        self.annotate = annotate
+        self._evals: Dict[str, Tuple[chess.engine.Score, str]] = {}
+        self._lock = threading.Lock()
+
+    def get_score(self, board: chess.Board) -> Tuple[chess.engine.Score, str]:
+        """
+        :return: the score from white's point of view and the engine's extra comment
+        """
+        key = board.epd()
+        with self._lock:
+            if key not in self._evals:
+                METRICS.inc('lazy_evals_total')
+                self._evals[key] = analyse_position(board, self.engine, self.limit, cache=self.cache)
+            return self._evals[key]
+
+    def provide(self, board: chess.Board, node: chess.pgn.GameNode = None, record=None,
+                ply: int = None) -> chess.engine.PovScore:
+        """
+        the eval of the position on board, saved into the node or the GameRecord at ply it came from
+        """
+        score, extra_comment = self.get_score(board)
+        if self.annotate and node is not None:
+            add_eval_comment(node, format_score(score), score, extra_comment, limit=self.limit)
+        if self.annotate and record is not None:
+            record.set_eval(ply, score)
+        return chess.engine.PovScore(score, chess.WHITE)
+
+
+class GameOrderedSchedule:
+    """
+    analyses a game's positions from the last one back to the first on the same engine without clearing its hash,
+    so the search of a position starts from what the engine already found for the positions after it
+    and gets deeper (or as deep, sooner) than independent searches, give the engine a large Hash for this to pay off
+    ie: ENGINE_OPTIONS = {"Hash": 1024}
+    """
+    def __init__(self, reverse: bool = True, new_game: Union[bool, Callable[[chess.pgn.Game], bool]] = True):
+        """
+        :param reverse: final position first
+        :param new_game: whether to send `ucinewgame` (and so clear the hash) before each game,
+            can be a function of the game, ie: to only clear it between games of different openings
+        """
+        self.reverse = reverse
+        self.new_game = new_game
+        self._lock = threading.Lock()
+        self._game_keys: Dict[int, object] = {}
+
+    def game_key(self, game: chess.pgn.Game, engine) -> object:
+        """
+        the key to analyse all of this game's positions with, see analyse_position
+        """
+        new_game = self.new_game(game) if callable(self.new_game) else self.new_game
+        with self._lock:
+            # one instance is shared by every engine thread, each engine continues its own previous game
+            if new_game or id(engine) not in self._game_keys:
+                self._game_keys[id(engine)] = object()
+            return self._game_keys[id(engine)]
+
+    def order(self, nodes: List[chess.pgn.GameNode]) -> List[chess.pgn.GameNode]:
+        return nodes[::-1] if self.reverse else nodes
+
+
+class AdaptiveAnalysis:
+    """
+    two pass analysis, every position first gets a cheap `quick_limit` search and only the positions where
+    the eval matters get the full analysis_time: big swings between consecutive positions (blunders) and
+    evals close to the rating bands `analysis_utils` uses to decide what a bad move is
+    deep searches are spent from the biggest swing down until the per game or per corpus budget runs out
+    one instance can be shared across games (and engine threads) to keep a corpus wide budget
+    """
+    def __init__(self, quick_limit: chess.engine.Limit = chess.engine.Limit(depth=8), swing_threshold: int = 100,
+                 rating_bands: Tuple[int, ...] = (175,), band_margin: int = 50,
+                 game_budget: float = None, corpus_budget: float = None):
+        """
+        :param swing_threshold: in centipawns, positions before and after an eval change this big are deepened
+        :param rating_bands: in centipawns, positions with abs(eval) within band_margin of a band are deepened
+        :param game_budget: seconds of deep analysis per game, None for no limit
+        :param corpus_budget: seconds of deep analysis for all games together, None for no limit
+        """
+        self.quick_limit = quick_limit
+        self.swing_threshold = swing_threshold
+        self.rating_bands = rating_bands
+        self.band_margin = band_margin
+        self.game_budget = game_budget
+        self.corpus_budget_left = corpus_budget
+        self._lock = threading.Lock()
+
+    def _priorities(self, scores: List[chess.engine.Score]) -> Dict[int, float]:
+        # mates are already decisive, a deeper search won't change what analysis_utils does with them
+        cps = [None if score.is_mate() else score.score() for score in scores]
+        priorities = {}
+        for i, cp in enumerate(cps):
+            if cp is None:
+                continue
+            for band in self.rating_bands:
+                distance = abs(abs(cp) - abs(band))
+                if distance <= self.band_margin:
+                    priorities[i] = max(priorities.get(i, 0), self.band_margin - distance)
+            if i == 0 or cps[i - 1] is None:
+                continue
+            swing = abs(cp - cps[i - 1])
+            if swing >= self.swing_threshold:
+                for j in (i - 1, i):
+                    priorities[j] = max(priorities.get(j, 0), swing)
+        return priorities
+
+    def _take_budget(self, analysis_time: float, game_spent: float) -> bool:
+        if self.game_budget is not None and game_spent + analysis_time > self.game_budget:
+            return False
+        with self._lock:
+            if self.corpus_budget_left is None:
+                return True
+            if self.corpus_budget_left < analysis_time:
+                return False
+            self.corpus_budget_left -= analysis_time
+            return True
+
+    def add_eval_to_game(self, game: chess.pgn.Game, engine: chess.engine.SimpleEngine, analysis_time: float,
+                         should_re_add_analysis: bool = False, cache: EvalCache = None,
+                         schedule: GameOrderedSchedule = None) -> chess.pgn.Game:
+        """
+        MODIFIES "game" IN PLACE
+        :param schedule: the order of the quick pass and whether the engine starts a new game
+        """
+        nodes = []
+        current_move = _first_node_to_analyze(game)
+        while len(current_move.variations):
+            nodes.append(current_move)
+            current_move = current_move.variations[0]
+        game_key = None if schedule is None else schedule.game_key(game, engine)
+        deep_limit = chess.engine.Limit(time=analysis_time)
+        server_analysis = has_server_analysis(game)
+        scores: List[chess.engine.Score] = [None] * len(nodes)
+        limits: Dict[int, chess.engine.Limit] = {}
+        extra_comments = {}
+        to_analyze = []
+        # evals kept from before that only meet the quick limit can still be deepened
+        to_deepen = []
+        for i, node in enumerate(nodes):
+            if not should_re_add_analysis and eval_meets_limit(node.comment, deep_limit, server_analysis):
+                scores[i] = node.eval().pov(chess.WHITE)
+                continue
+            if not should_re_add_analysis and eval_meets_limit(node.comment, self.quick_limit, server_analysis):
+                scores[i] = node.eval().pov(chess.WHITE)
+                to_deepen.append(i)
+                continue
+            node.comment = strip_eval(node.comment)
+            to_analyze.append(i)
+        for i in (to_analyze if schedule is None else schedule.order(to_analyze)):
+            scores[i], extra_comments[i] = analyse_position(nodes[i].board(), engine, self.quick_limit, cache=cache,
+                                                            game_key=game_key)
+            limits[i] = self.quick_limit
+        priorities = self._priorities(scores)
+        game_spent = 0.0
+        for i in sorted(filter(lambda i: i in priorities, to_analyze + to_deepen), key=lambda i: -priorities[i]):
+            if not self._take_budget(analysis_time, game_spent):
+                break
+            start = time.time()
+            scores[i], extra_comments[i] = analyse_position(
+                nodes[i].board(), engine, deep_limit, cache=cache, game_key=game_key
+            )
+            game_spent += time.time() - start
+            if i not in limits:
+                nodes[i].comment = strip_eval(nodes[i].comment)
+            limits[i] = deep_limit
+        for i, limit in limits.items():
+            add_eval_comment(nodes[i], format_score(scores[i]), scores[i], extra_comments[i], limit=limit)
+        num_deepened = sum(limit is deep_limit for limit in limits.values())
+        logger.debug(f"deepened {num_deepened} out of {len(limits)} positions in {game.headers.get('ID')}")
+        return game
 
 
 def add_eval_to_game(game: chess.pgn.Game, engine: chess.engine.SimpleEngine, analysis_time: float,
-                     should_re_add_analysis: bool = False) -> chess.pgn.Game:
+                     should_re_add_analysis: bool = False, cache: EvalCache = None,
+                     adaptive: AdaptiveAnalysis = None, schedule: GameOrderedSchedule = None) -> chess.pgn.Game:
     """
     MODIFIES "game" IN PLACE
+    positions that already have an eval at least as long as analysis_time are skipped unless should_re_add_analysis,
+    see eval_meets_limit
+    :param adaptive: only deepen the positions that matter, see AdaptiveAnalysis
+    :param schedule: the order positions are analysed in and whether the engine starts a new game,
+        see GameOrderedSchedule, by default first move first and the engine's hash is kept from the previous game
     """
-    current_move = game
+    if is_game_analyzed(game, analysis_time, adaptive is not None) and not should_re_add_analysis:
+        return game
+    if adaptive is not None:
+        game = adaptive.add_eval_to_game(game, engine, analysis_time, should_re_add_analysis=should_re_add_analysis,
+                                         cache=cache, schedule=schedule)
+        game.headers[ANALYSIS_TIME_HEADER] = get_analysis_header_value(analysis_time, adaptive=True)
+        return game
+    limit = chess.engine.Limit(time=analysis_time)
+    server_analysis = has_server_analysis(game)
+    nodes = []
+    current_move = _first_node_to_analyze(game)
     while len(current_move.variations):
-        if "eval" in current_move.comment and not should_re_add_analysis:
+        # only evals at least as long as analysis_time are kept, see eval_meets_limit
+        if not should_re_add_analysis and eval_meets_limit(current_move.comment, limit, server_analysis):
+            current_move = current_move.variations[0]
             continue
-        score, actual_eval = get_score(current_move.board(), engine, analysis_time=analysis_time)
-        current_move.comment += f'[%eval {score}]'
-        if current_move.eval().pov(chess.WHITE) != actual_eval:
-            # assert not rounding error
-            assert abs(current_move.eval().pov(chess.WHITE).score() - actual_eval.score()) == 1, \
-                f"eval's not equal, not rounding error: {current_move.eval().pov(chess.WHITE)} != {actual_eval}"
+        current_move.comment = strip_eval(current_move.comment)
+        nodes.append(current_move)
         current_move = current_move.variations[0]
+    game_key = None if schedule is None else schedule.game_key(game, engine)
+    for node in (nodes if schedule is None else schedule.order(nodes)):
+        actual_eval, extra_comment = analyse_position(node.board(), engine, limit, cache=cache, game_key=game_key)
+        add_eval_comment(node, format_score(actual_eval), actual_eval, extra_comment, limit=limit)
+    game.headers[ANALYSIS_TIME_HEADER] = str(analysis_time)
     return game
 
 
-def add_eval_to_games(games: List[chess.pgn.Game], engine: chess.engine.SimpleEngine, analysis_time) -> List[
-    chess.pgn.Game]:
+def add_eval_to_games(games: List[chess.pgn.Game], engine: chess.engine.SimpleEngine, analysis_time,
+                      cache: EvalCache = None,
+                      on_game_analyzed: Callable[[int, chess.pgn.Game], None] = None,
+                      adaptive: AdaptiveAnalysis = None,
+                      schedule: GameOrderedSchedule = None) -> List[chess.pgn.Game]:
     """
     MODIFIES "game" IN PLACE
+    :param on_game_analyzed: called with the index and the game once each game is done, ie: to checkpoint it
     """
     start = time.time()
     for i in range(len(games)):
-        games[i] = add_eval_to_game(games[i], engine, analysis_time=analysis_time)
-        total_elapses_so_far = time.time() - start
-        expected_time = total_elapses_so_far * (len(games) / (i + 1))
-        if i % 10 == 0:
-            logger.info(f"done analysis for {i} games out of {len(games)} ({round(round(i / len(games), 3) * 100, 3)}%), "
-                        f"should take expected {expected_time / 60} minutes "
-                        f"or around {round(expected_time / 3600, 2)} hours. "
-                        f"Time left is around {expected_time / 60 * (1 - i / len(games))} minutes")
+        games[i] = add_eval_to_game(games[i], engine, analysis_time=analysis_time, cache=cache, adaptive=adaptive,
+                                    schedule=schedule)
+        if on_game_analyzed is not None:
+            on_game_analyzed(i, games[i])
+        log_progress('analysis', i + 1, len(games), start)
+    return games
+
+
+def open_engine(engine_path: Union[str, List[str]], engine_options: Dict[str, Union[str, int, bool]] = None,
+                ensemble_method: str = 'mean') -> Union[chess.engine.SimpleEngine, EngineEnsemble]:
+    """
+    starts a uci engine and applies the uci options (ie: {"Threads": 2, "Hash": 256})
+    a list of engine paths starts an EngineEnsemble that combines their scores with ensemble_method
+    """
+    if isinstance(engine_path, (list, tuple)):
+        engine = EngineEnsemble.popen_uci(engine_path, engine_options, method=ensemble_method)
+    else:
+        engine = chess.engine.SimpleEngine.popen_uci(engine_path)
+        if engine_options:
+            engine.configure(engine_options)
+    engine.eval_cache_identity = engine_identity(engine.id.get('name', ''), engine_options)
+    return engine
+
+
+class LazyEngine:
+    """
+    stands in for the engine open_engine would start, but only starts it the first time it is used,
+    so runs with nothing left to analyze never pay for an engine process
+    the eval cache remembers the identity (uci name and options) of every engine binary it saw, so positions
+    already in the cache are read without starting the engine, unless the binary changed since, ie: an upgrade
+    """
+    def __init__(self, engine_path: Union[str, List[str]], engine_options: Dict[str, Union[str, int, bool]] = None,
+                 ensemble_method: str = 'mean'):
+        self.engine_path = engine_path
+        self.engine_options = engine_options
+        self.ensemble_method = ensemble_method
+        self._identity = None
+        self._engine = None
+        self._lock = threading.Lock()
+
+    @property
+    def started(self) -> bool:
+        return self._engine is not None
+
+    def _get_engine(self) -> Union[chess.engine.SimpleEngine, EngineEnsemble]:
+        with self._lock:
+            if self._engine is None:
+                logger.info(f"starting {self.engine_path}")
+                self._engine = open_engine(self.engine_path, self.engine_options, self.ensemble_method)
+            return self._engine
+
+    def _binary_key(self) -> Union[str, None]:
+        # the engines' files as they are now, None when one can't be found without starting it
+        paths = self.engine_path if isinstance(self.engine_path, (list, tuple)) else [self.engine_path]
+        files = []
+        for path in paths:
+            path = shutil.which(path) or path
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            files.append(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}")
+        return f"{self.ensemble_method}|{'|'.join(files)}|{engine_identity('', self.engine_options)}"
+
+    def get_identity(self, cache: EvalCache = None) -> str:
+        """
+        see get_engine_identity, the engine is only started when the cache doesn't know this binary yet
+        """
+        if self._identity is None:
+            binary = self._binary_key() if cache is not None else None
+            identity = cache.get_engine_identity(binary) if binary is not None else None
+            if identity is None:
+                identity = get_engine_identity(self._get_engine())
+                if binary is not None:
+                    cache.put_engine_identity(binary, identity)
+            self._identity = identity
+        return self._identity
+
+    def __getattr__(self, name):
+        # only called for what LazyEngine doesn't have itself, ie: analyse, configure, id
+        return getattr(self._get_engine(), name)
+
+    def quit(self):
+        """
+        the next use starts a new engine, ie: after the engine died
+        """
+        engine, self._engine = self._engine, None
+        if engine is not None:
+            quit_engine(engine)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.quit()
+
+
+def add_eval_to_games_parallel(games: List[chess.pgn.Game], engine_path: Union[str, List[str]], analysis_time,
+                               workers: int,
+                               engine_options: Dict[str, Union[str, int, bool]] = None,
+                               cache: EvalCache = None,
+                               on_game_analyzed: Callable[[int, chess.pgn.Game], None] = None,
+                               adaptive: AdaptiveAnalysis = None,
+                               schedule: GameOrderedSchedule = None) -> List[chess.pgn.Game]:
+    """
+    MODIFIES "game" IN PLACE
+    same as add_eval_to_games but spreads the games across `workers` engine processes,
+    each one driven by its own thread. results are written back by index so the order of "games" is kept
+    on_game_analyzed is called from the worker threads, but never by two at the same time
+    """
+    game_indices = queue.Queue()
+    for i in range(len(games)):
+        game_indices.put(i)
+    lock = threading.Lock()
+    errors = []
+    done = 0
+    start = time.time()
+
+    def worker():
+        nonlocal done
+        # a worker left without games never starts its engine
+        with LazyEngine(engine_path, engine_options) as engine:
+            while not errors:
+                try:
+                    i = game_indices.get_nowait()
+                except queue.Empty:
+                    return
+                games[i] = add_eval_to_game(games[i], engine, analysis_time=analysis_time, cache=cache,
+                                            adaptive=adaptive, schedule=schedule)
+                with lock:
+                    if on_game_analyzed is not None:
+                        on_game_analyzed(i, games[i])
+                    done += 1
+                    log_progress('analysis', done, len(games), start)
+
+    def run_worker():
+        try:
+            worker()
+        except Exception as e:
+            logger.exception("engine worker failed")
+            errors.append(e)
+
+    threads = [threading.Thread(target=run_worker, name=f"engine-worker-{n}", daemon=True)
+               for n in range(min(workers, len(games)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
     return games
@@ -1,6 +1,12 @@
+from typing import Iterator, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
 import chess.pgn
 import chess.engine
 
+from game_record import GameRecord, unpack_move
+
 
 def get_move(game: chess.pgn.Game, move_num: int) -> chess.pgn.GameNode:
     i = 0
@@ -11,28 +17,63 @@ def get_move(game: chess.pgn.Game, move_num: int) -> chess.pgn.GameNode:
     return current_game
 
 
-def get_first_move_with_bad_move(game: chess.pgn.Game, player_to_follow: str, min_rating=-float('inf'), max_rating=float('inf')):
+def _mainline_evals(game: Union[chess.pgn.Game, GameRecord],
+                    eval_provider=None) -> Iterator[Tuple[int, chess.engine.PovScore]]:
+    """
+    yields the half move number and the eval after it, a GameRecord gives them without parsing any comments
+    :param eval_provider: asked for the evals the game doesn't have, only when the caller gets to that half move,
+        see add_chess_analysis.LazyEvalProvider
+    """
+    if isinstance(game, GameRecord):
+        board = game.starting_board() if eval_provider is not None else None
+        for i in range(1, game.num_plies + 1):
+            if board is not None:
+                board.push(unpack_move(int(game.moves[i - 1])))
+            eval = game.eval(i)
+            if eval is None and eval_provider is not None:
+                eval = eval_provider.provide(board, record=game, ply=i)
+            yield i, eval
+        return
+    board = game.board() if eval_provider is not None else None
     current_move = game
     i = 0
-    if game.headers['White'] == player_to_follow:
-        color_following = chess.WHITE
-    elif game.headers['Black'] == player_to_follow:
-        color_following = chess.BLACK
-    else:
-        raise ValueError(f"white ({game.headers['white']}) or black ({game.headers['black']}) isn't {player_to_follow}")
-    last_eval: chess.engine.Score = chess.engine.Cp(0)
     while len(current_move.variations):
         i += 1
         current_move: chess.pgn.GameNode = current_move.variations[0]
+        if board is not None:
+            board.push(current_move.move)
+        eval = current_move.eval()
+        if eval is None and eval_provider is not None:
+            eval = eval_provider.provide(board, node=current_move)
+        yield i, eval
+
+
+def _get_color_following(game: Union[chess.pgn.Game, GameRecord], player_to_follow: str) -> chess.Color:
+    if game.headers['White'] == player_to_follow:
+        return chess.WHITE
+    elif game.headers['Black'] == player_to_follow:
+        return chess.BLACK
+    raise ValueError(f"white ({game.headers['White']}) or black ({game.headers['Black']}) isn't {player_to_follow}")
+
+
+def get_first_move_with_bad_move(game: Union[chess.pgn.Game, GameRecord], player_to_follow: str, min_rating=-float('inf'), max_rating=float('inf'),
+                                 eval_provider=None):
+    """
+    :param eval_provider: analyses the missing evals on demand, so only the half moves up to the first bad move
+        are ever analyzed, without it a missing eval returns (i, None)
+    """
+    i = 0
+    color_following = _get_color_following(game, player_to_follow)
+    last_eval: chess.engine.Score = chess.engine.Cp(0)
+    for i, eval in _mainline_evals(game, eval_provider):
         if (color_following == chess.WHITE and i % 2 == 0) or \
            (color_following == chess.BLACK and i % 2 == 1):
             # if playing white, then eval white's moves, and visa versa
             # so lets get eval on opponents turn and
-            if current_move.eval() is None:
+            if eval is None:
                 return i, None
-            last_eval = current_move.eval().pov(color_following)
+            last_eval = eval.pov(color_following)
             continue
-        eval: chess.engine.PovScore = current_move.eval()
         if eval is None:
             return i, None  # log it
         score_following: chess.engine.Score = eval.pov(color_following)
@@ -55,28 +96,21 @@ def get_first_move_with_bad_move(game: chess.pgn.Game, player_to_follow: str, mi
     return i, 0.0
 
 
-def get_all_losses_for_my_moves(game: chess.pgn.Game, player_to_follow: str):
-    current_move = game
-    i = 0
-    if game.headers['White'] == player_to_follow:
-        color_following = chess.WHITE
-    elif game.headers['Black'] == player_to_follow:
-        color_following = chess.BLACK
-    else:
-        raise ValueError(f"white ({game.headers['white']}) or black ({game.headers['black']}) isn't {player_to_follow}")
+def get_all_losses_for_my_moves(game: Union[chess.pgn.Game, GameRecord], player_to_follow: str, eval_provider=None):
+    """
+    :param eval_provider: analyses the missing evals on demand, otherwise the losses stop at the first missing eval
+    """
+    color_following = _get_color_following(game, player_to_follow)
     last_eval: chess.engine.Score = chess.engine.Cp(0)
-    while len(current_move.variations):
-        i += 1
-        current_move: chess.pgn.GameNode = current_move.variations[0]
+    for i, eval in _mainline_evals(game, eval_provider):
         if (color_following == chess.WHITE and i % 2 == 0) or \
            (color_following == chess.BLACK and i % 2 == 1):
             # if playing white, then eval white's moves, and visa versa
             # so lets get eval on opponents turn and
-            if current_move.eval() is None:
+            if eval is None:
                 return
-            last_eval = current_move.eval().pov(color_following)
+            last_eval = eval.pov(color_following)
             continue
-        eval: chess.engine.PovScore = current_move.eval()
         if eval is None:
             return
         score_following: chess.engine.Score = eval.pov(color_following)
@@ -94,3 +128,115 @@ def get_all_losses_for_my_moves(game: chess.pgn.Game, player_to_follow: str):
         difference_in_eval: int = last_eval.score() - score
         yield i, difference_in_eval
     return
+
+
+def ply_to_move_num(ply):
+    # the same move numbering the notebook uses, white's and black's first moves are both move 1
+    return (ply + 1) // 2
+
+
+class EvalCorpus:
+    """
+    the evals of many games from one player's point of view as padded arrays (one row per game, one column per
+    position, index 0 being the starting position), so corpus wide metrics are computed in a few numpy operations
+    instead of walking every game, results match get_all_losses_for_my_moves and get_first_move_with_bad_move
+    """
+    def __init__(self, games: List[Union[chess.pgn.Game, GameRecord]], player_to_follow: str):
+        records = [game if isinstance(game, GameRecord) else GameRecord.from_game(game) for game in games]
+        num_games = len(records)
+        width = max((record.num_plies for record in records), default=0) + 1
+        self.player_to_follow = player_to_follow
+        self.ids = [record.headers.get('ID', record.headers.get('Site')) for record in records]
+        self.num_plies = np.array([record.num_plies for record in records], dtype=np.int64)
+        self.playing_white = np.array(
+            [_get_color_following(record, player_to_follow) == chess.WHITE for record in records], dtype=bool
+        )
+        self.evals = np.zeros((num_games, width), dtype=np.int64)
+        self.is_mate = np.zeros((num_games, width), dtype=bool)
+        self.has_eval = np.zeros((num_games, width), dtype=bool)
+        for row, record in enumerate(records):
+            n = record.num_plies + 1
+            self.evals[row, :n] = record.evals
+            self.is_mate[row, :n] = record.is_mate
+            self.has_eval[row, :n] = record.has_eval
+        # to the followed player's point of view
+        self.evals[~self.playing_white] *= -1
+
+        self.plies = np.arange(width)[None, :]
+        in_game = (self.plies >= 1) & (self.plies <= self.num_plies[:, None])
+        missing = in_game & ~self.has_eval
+        # every metric stops at the first position without an eval
+        self.first_missing = np.where(missing.any(axis=1), missing.argmax(axis=1), width)
+        self.usable = in_game & (self.plies < self.first_missing[:, None])
+        self.my_plies = self.usable & ((self.plies % 2 == 1) == self.playing_white[:, None])
+        # eval before each of my moves, the starting position counts as 0 like in get_all_losses_for_my_moves
+        self.previous_evals = np.zeros_like(self.evals)
+        self.previous_evals[:, 1:] = self.evals[:, :-1]
+        self.previous_evals[:, 1] = 0
+        self.previous_is_mate = np.zeros_like(self.is_mate)
+        self.previous_is_mate[:, 1:] = self.is_mate[:, :-1]
+        self.previous_is_mate[:, 1] = False
+
+    def _loss_matrix(self) -> np.ndarray:
+        with np.errstate(invalid='ignore'):
+            return np.where(
+                self.previous_is_mate,
+                np.where(self.is_mate, 0.0, np.inf),
+                np.where(self.is_mate, np.inf, (self.previous_evals - self.evals).astype(np.float64))
+            )
+
+    def losses(self) -> pd.DataFrame:
+        """
+        one row per move of the followed player, like get_all_losses_for_my_moves for every game
+        """
+        rows, plies = np.nonzero(self.my_plies)
+        return pd.DataFrame({
+            'game_index': rows,
+            'id': np.array(self.ids, dtype=object)[rows],
+            'ply': plies,
+            'move_num': ply_to_move_num(plies),
+            'loss': self._loss_matrix()[rows, plies]
+        })
+
+    def first_bad_moves(self, min_rating=-float('inf'), max_rating=float('inf')) -> pd.DataFrame:
+        """
+        one row per game, like get_first_move_with_bad_move, `loss` is nan (instead of None) when an eval was missing
+        """
+        previous_is_cp = ~self.previous_is_mate
+        bad = self.my_plies & (
+            (self.previous_is_mate != self.is_mate) |
+            (previous_is_cp & ~self.is_mate & (
+                ((min_rating < self.evals) & (self.evals < max_rating) & (max_rating < self.previous_evals)) |
+                (self.evals < min_rating)
+            ))
+        )
+        width = self.evals.shape[1]
+        first_bad = np.where(bad.any(axis=1), bad.argmax(axis=1), width)
+        has_missing = self.first_missing < width
+        ply = np.minimum(first_bad, self.first_missing)
+        found = ply < width
+        ply = np.where(found, ply, self.num_plies)
+        loss = np.zeros(len(ply), dtype=np.float64)
+        rows = np.nonzero(found)[0]
+        loss[rows] = self._loss_matrix()[rows, ply[rows]]
+        missing = has_missing & (self.first_missing <= first_bad)
+        loss[missing] = np.nan
+        return pd.DataFrame({
+            'game_index': np.arange(len(ply)),
+            'id': self.ids,
+            'ply': ply,
+            'move_num': ply_to_move_num(ply),
+            'loss': loss,
+            'missing_eval': missing
+        })
+
+    @staticmethod
+    def by_move_number(losses: pd.DataFrame) -> pd.DataFrame:
+        """
+        average loss and number of moves per move number, for the output of `losses` or `first_bad_moves`
+        moves losing mate (inf) and missing evals are left out of the average and counted in `total_inf`
+        """
+        finite = losses[np.isfinite(losses['loss'])]
+        data = finite.groupby('move_num').agg(avg_loss=('loss', 'mean'), total_moves=('loss', 'size'))
+        data['total_inf'] = losses[np.isinf(losses['loss'])].groupby('move_num').size()
+        return data.fillna({'total_inf': 0}).astype({'total_inf': int}).reset_index()
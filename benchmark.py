@@ -0,0 +1,365 @@
+from typing import Callable, Dict, Iterator, List
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import string
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import chess
+import chess.engine
+import chess.pgn
+
+import bulk_downloader
+import lichess_data_manager
+import lichess_to_python_chess
+import local_data_manager
+from add_chess_analysis import (
+    add_eval_to_games, add_eval_to_games_parallel, format_score, open_engine, GameOrderedSchedule
+)
+from analysis_utils import EvalCorpus, get_all_losses_for_my_moves
+from fake_uci_engine import hashed_eval
+from metrics import profile_stage
+
+logger = logging.getLogger(__name__)
+
+FAKE_ENGINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_uci_engine.py')
+BENCHMARK_USER = 'benchmark'
+_START_TIMESTAMP = 1_600_000_000_000
+
+
+def _random_id(rng: random.Random) -> str:
+    return ''.join(rng.choice(string.ascii_letters + string.digits) for _ in range(8))
+
+
+def generate_game_json(rng: random.Random, i: int, player: str = BENCHMARK_USER, max_plies: int = 80,
+                       analysed: bool = False) -> dict:
+    """
+    a random legal standard game shaped like a lichess export with pgnInJson, clocks, evals and opening
+    """
+    board = chess.Board()
+    game = chess.pgn.Game()
+    node = game
+    clocks = []
+    clock_left = [18000, 18000]
+    for ply in range(rng.randint(10, max_plies)):
+        if board.is_game_over():
+            break
+        move = rng.choice(sorted(board.legal_moves, key=lambda m: m.uci()))
+        board.push(move)
+        node = node.add_variation(move)
+        side = ply % 2
+        clock_left[side] = max(clock_left[side] - rng.randint(0, 900) + 200, 0)
+        clocks.append(clock_left[side])
+        if analysed:
+            node.comment += f'[%eval {format_score(chess.engine.Cp(hashed_eval(board)))}]'
+        node.set_clock(clock_left[side] / 100.)
+    num_plies = len(clocks)
+    playing_white = i % 2 == 0
+    opponent = f'opponent{i % 50}'
+    white, black = (player, opponent) if playing_white else (opponent, player)
+    if board.is_checkmate():
+        status, winner = 'mate', 'black' if board.turn == chess.WHITE else 'white'
+    else:
+        status, winner = rng.choice([('resign', 'white'), ('resign', 'black'), ('draw', None)])
+    result = {'white': '1-0', 'black': '0-1', None: '1/2-1/2'}[winner]
+    game_id = _random_id(rng)
+    created_at = _START_TIMESTAMP + i * 600_000
+    game.headers.update({
+        'Event': 'Rated Blitz game',
+        'Site': lichess_to_python_chess.id_to_site(game_id),
+        'White': white,
+        'Black': black,
+        'Result': result,
+        'WhiteElo': '1500',
+        'BlackElo': '1500',
+        'Variant': 'Standard',
+        'TimeControl': '180+2',
+        'ECO': 'A00',
+        'Opening': 'Benchmark Opening',
+        'Termination': 'Normal'
+    })
+    game_json = {
+        'id': game_id,
+        'rated': True,
+        'variant': 'standard',
+        'speed': 'blitz',
+        'perf': 'blitz',
+        'createdAt': created_at,
+        'lastMoveAt': created_at + num_plies * 3000,
+        'status': status,
+        'players': {
+            'white': {'user': {'name': white, 'id': white.lower()}, 'rating': 1500, 'ratingDiff': 0},
+            'black': {'user': {'name': black, 'id': black.lower()}, 'rating': 1500, 'ratingDiff': 0}
+        },
+        'opening': {'eco': 'A00', 'name': 'Benchmark Opening', 'ply': 2},
+        'moves': ' '.join(_sans(game)),
+        'clocks': clocks,
+        'pgn': str(game) + '\n',
+        'clock': {'initial': 180, 'increment': 2, 'totalTime': 260}
+    }
+    if winner is not None:
+        game_json['winner'] = winner
+    if analysed:
+        board = chess.Board()
+        game_json['analysis'] = []
+        for move in game.mainline_moves():
+            board.push(move)
+            game_json['analysis'].append({'eval': hashed_eval(board)})
+    return game_json
+
+
+def _sans(game: chess.pgn.Game) -> List[str]:
+    board = game.board()
+    sans = []
+    for move in game.mainline_moves():
+        sans.append(board.san(move))
+        board.push(move)
+    return sans
+
+
+def generate_corpus(num_games: int, seed: int = 0, player: str = BENCHMARK_USER, max_plies: int = 80,
+                    analysed_fraction: float = 0.) -> List[dict]:
+    """
+    the same seed always gives the same games, oldest first
+    :param analysed_fraction: share of the games that come with lichess server analysis
+    """
+    rng = random.Random(seed)
+    return [
+        generate_game_json(rng, i, player=player, max_plies=max_plies, analysed=rng.random() < analysed_fraction)
+        for i in range(num_games)
+    ]
+
+
+def _make_handler(games: List[dict], throttled_requests: int, retry_after: float):
+    # games appended to the list while serving are served too, each one is only encoded once
+    lines = []
+    throttled = {'left': throttled_requests}
+    lock = threading.Lock()
+
+    class CorpusHandler(BaseHTTPRequestHandler):
+        # serves /games/user/<userid> like the lichess export, only `since`, `until` and `max` are honored
+        def do_GET(self):
+            with lock:
+                throttle = throttled['left'] > 0
+                throttled['left'] -= throttle
+            if throttle:
+                self.send_response(429)
+                self.send_header('Retry-After', str(retry_after))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            lines.extend(json.dumps(game_json).encode('utf8') + b'\n' for game_json in games[len(lines):])
+            url = urlparse(self.path)
+            if not url.path.startswith('/games/user/'):
+                self.send_error(404)
+                return
+            query = parse_qs(url.query)
+            since = int(query.get('since', [0])[0])
+            until = int(query.get('until', [sys.maxsize])[0])
+            selected = [line for game_json, line in zip(games, lines) if since <= game_json['createdAt'] <= until]
+            if 'max' in query:
+                selected = selected[:int(query['max'][0])]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Content-Length', str(sum(len(line) for line in selected)))
+            self.end_headers()
+            for line in selected:
+                self.wfile.write(line)
+
+        def log_message(self, format, *args):
+            pass
+
+    return CorpusHandler
+
+
+@contextmanager
+def serve_corpus(games: List[dict], throttled_requests: int = 0, retry_after: float = 1.) -> Iterator[str]:
+    """
+    a local stand-in for the lichess export api
+    :param games: can be appended to while serving, ie: to have new games to sync
+    :param throttled_requests: the first requests get a 429 with a Retry-After of retry_after seconds, like lichess
+    :return: the base url to pass as `base_url`
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(games, throttled_requests, retry_after))
+    thread = threading.Thread(target=server.serve_forever, name='benchmark-server', daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _current_rss() -> int:
+    # bytes, /proc is only there on linux, elsewhere it falls back to the peak of the whole process
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class _PeakRss:
+    """
+    samples the resident memory in the background while a stage runs
+    """
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='benchmark-rss', daemon=True)
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = _current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _current_rss())
+
+
+def run_stage(name: str, func: Callable[[], object], results: List[dict], num_games: int, num_positions: int):
+    """
+    times func and appends its throughput and peak memory to results, it is profiled when profiling is enabled
+    :return: the result of func
+    """
+    with _PeakRss() as rss, profile_stage(name):
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+    results.append({
+        'stage': name,
+        'seconds': seconds,
+        'games': num_games,
+        'positions': num_positions,
+        'games_per_second': num_games / seconds if seconds else float('inf'),
+        'positions_per_second': num_positions / seconds if seconds else float('inf'),
+        'peak_rss_mb': rss.peak / 2 ** 20
+    })
+    logger.info(f"{name}: {num_games} games, {num_positions} positions in {seconds:.3f} seconds")
+    return result
+
+
+def run_benchmark(num_games: int = 200, seed: int = 0, analysis_time: float = 0.01, latency_ms: int = 1,
+                  workers: int = 1, analysed_fraction: float = 0., reverse: bool = False) -> List[dict]:
+    """
+    runs every stage on a synthetic corpus, against a local server and the fake engine, in a temporary folder
+    :param reverse: analyse with a GameOrderedSchedule
+    :return: one dict per stage with seconds, games, positions, games_per_second, positions_per_second, peak_rss_mb
+    """
+    results = []
+    corpus = generate_corpus(num_games, seed=seed, analysed_fraction=analysed_fraction)
+    counts = {'num_games': len(corpus), 'num_positions': sum(len(g['moves'].split()) + 1 for g in corpus)}
+    engine_options = {'Latency': latency_ms}
+    schedule = GameOrderedSchedule() if reverse else None
+
+    def analyse(games):
+        if workers > 1:
+            return add_eval_to_games_parallel(games, FAKE_ENGINE_PATH, analysis_time, workers,
+                                              engine_options=engine_options, schedule=schedule)
+        with open_engine(FAKE_ENGINE_PATH, engine_options) as engine:
+            return add_eval_to_games(games, engine, analysis_time, schedule=schedule)
+
+    cwd = os.getcwd()
+    # the last games are only served after the first download, so the second sync is an incremental one
+    served = corpus[:len(corpus) - max(len(corpus) // 10, 1)]
+    num_new_games = len(corpus) - len(served)
+    with tempfile.TemporaryDirectory() as work_dir, serve_corpus(served) as base_url:
+        # the data managers write to ./data
+        os.chdir(work_dir)
+        try:
+            run_stage('download', lambda: lichess_data_manager.sync_games(BENCHMARK_USER, base_url=base_url),
+                      results, num_games=len(served),
+                      num_positions=sum(len(g['moves'].split()) + 1 for g in served))
+            served.extend(corpus[len(served):])
+            synced = run_stage('sync', lambda: lichess_data_manager.sync_games(BENCHMARK_USER, base_url=base_url),
+                               results, num_games=num_new_games, num_positions=0)
+            if synced != num_new_games:
+                raise RuntimeError(f"the incremental sync got {synced} games instead of {num_new_games}")
+            run_stage('bulk_download', lambda: _bulk_download(corpus), results, num_games=2 * len(corpus),
+                      num_positions=0)
+            game_jsons = run_stage('read_raw', lambda: lichess_data_manager.read_data(BENCHMARK_USER),
+                                   results, **counts)
+            games = run_stage('convert', lambda: lichess_to_python_chess.convert_games(game_jsons), results, **counts)
+            run_stage('convert_records', lambda: lichess_to_python_chess.convert_game_records(game_jsons),
+                      results, **counts)
+            games = run_stage('analysis', lambda: analyse(games), results, **counts)
+            run_stage('save', lambda: local_data_manager.save_data(games, BENCHMARK_USER, analysis_time),
+                      results, **counts)
+            loaded = run_stage('load', lambda: local_data_manager.read_data(BENCHMARK_USER, analysis_time),
+                               results, **counts)
+            records = run_stage('load_records', lambda: local_data_manager.read_records(
+                BENCHMARK_USER, analysis_time, with_moves=False
+            ), results, **counts)
+            run_stage('metrics', lambda: [list(get_all_losses_for_my_moves(game, BENCHMARK_USER)) for game in loaded],
+                      results, **counts)
+            run_stage('metrics_vectorized', lambda: EvalCorpus(records, BENCHMARK_USER).losses(), results, **counts)
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def _bulk_download(corpus: List[dict], num_users: int = 2) -> Dict[str, dict]:
+    # every user's first request is throttled, so each one backs off once before downloading the whole corpus
+    userids = [f'{BENCHMARK_USER}{i}' for i in range(num_users)]
+    with serve_corpus(corpus, throttled_requests=num_users, retry_after=0.1) as base_url:
+        all_stats = bulk_downloader.download_users(userids, download=True, base_url=base_url,
+                                                   max_concurrency=num_users, requests_per_second=100.)
+    for userid, stats in all_stats.items():
+        if stats['error'] is not None or stats['games'] != len(corpus) or stats['attempts'] < 2:
+            raise RuntimeError(f"the throttled bulk download of {userid} went wrong: {stats}")
+    return all_stats
+
+
+def format_report(results: List[dict]) -> str:
+    lines = [f"{'stage':<20}{'seconds':>10}{'games/s':>12}{'positions/s':>14}{'peak RSS MB':>14}"]
+    for result in results:
+        lines.append(
+            f"{result['stage']:<20}{result['seconds']:>10.3f}{result['games_per_second']:>12.1f}"
+            f"{result['positions_per_second']:>14.1f}{result['peak_rss_mb']:>14.1f}"
+        )
+    return '\n'.join(lines)
+
+
+def main(argv: List[str] = None) -> Dict[str, dict]:
+    parser = argparse.ArgumentParser(description="offline throughput benchmark of every stage")
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--analysis-time', type=float, default=0.01)
+    parser.add_argument('--latency-ms', type=int, default=1, help="how long the fake engine takes per position")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--analysed-fraction', type=float, default=0.,
+                        help="share of games that come with lichess server analysis")
+    parser.add_argument('--reverse', action='store_true', help="analyse each game from its last position back")
+    parser.add_argument('--output', help="appends the results as json lines to this file")
+    args = parser.parse_args(argv)
+    results = run_benchmark(num_games=args.games, seed=args.seed, analysis_time=args.analysis_time,
+                            latency_ms=args.latency_ms, workers=args.workers,
+                            analysed_fraction=args.analysed_fraction, reverse=args.reverse)
+    print(format_report(results))
+    if args.output:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps({**result, **vars(args)}) + '\n')
+    return {result['stage']: result for result in results}
+
+
+if __name__ == '__main__':
+    main()
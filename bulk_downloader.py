@@ -0,0 +1,153 @@
+from typing import Dict, Iterable
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import lichess_data_manager
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# lichess asks to wait a full minute after a 429 when it doesn't say how long
+DEFAULT_RETRY_AFTER = 60.
+
+
+class RateLimiter:
+    """
+    token bucket shared by every download thread, `acquire` blocks until a request may be sent
+    `pause` stops every thread, ie: after a 429 the whole client backs off, not only the request that got it
+    """
+    def __init__(self, requests_per_second: float, burst: int = 1):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._paused_until = 0.
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.requests_per_second)
+                self._last = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.requests_per_second)
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def make_session(max_concurrency: int) -> requests.Session:
+    """
+    a session that keeps one connection per download thread open between requests
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _retry_after(response: requests.Response, attempt: int, backoff: float) -> float:
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    if response.status_code == 429:
+        return DEFAULT_RETRY_AFTER
+    return backoff * 2 ** attempt
+
+
+def _store_size(userid) -> int:
+    path = lichess_data_manager.get_path_to_user_id_games(userid)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def download_user(userid, download: bool, base_url: str = None, session: requests.Session = None,
+                  rate_limiter: RateLimiter = None, max_retries: int = 5, backoff: float = 1.) -> dict:
+    """
+    streams one users games into their ndjson store, retrying on 429, server errors and dropped connections
+    a retry after a partial download only asks for the games newer than the ones already appended
+    :param download: re-download the users entire history, otherwise only games newer than the stored ones
+    :return: the users throughput stats
+    """
+    stats = {'games': 0, 'bytes': 0, 'attempts': 0, 'seconds': 0., 'error': None}
+    start = time.time()
+    replace = download or not lichess_data_manager.data_exists(userid)
+    # the bytes downloaded are the bytes appended to the store, lines and their newlines
+    size_before = 0 if replace else _store_size(userid)
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        stats['attempts'] += 1
+        try:
+            if replace:
+                stats['games'] = lichess_data_manager.redownload_games(userid, base_url=base_url, session=session)
+            else:
+                stats['games'] += lichess_data_manager.sync_games(userid, base_url=base_url, session=session)
+            break
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+                raise
+            wait = _retry_after(e.response, attempt, backoff)
+            logger.warning(f"got {e.response.status_code} for {userid}, retrying in {wait} seconds")
+            if rate_limiter is not None and e.response.status_code == 429:
+                rate_limiter.pause(wait)
+            else:
+                time.sleep(wait)
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == max_retries:
+                raise
+            wait = backoff * 2 ** attempt
+            logger.warning(f"download of {userid} failed with {e}, retrying in {wait} seconds")
+            time.sleep(wait)
+    stats['bytes'] = _store_size(userid) - size_before
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def download_users(userids: Iterable[str], download: bool = False, base_url: str = None, max_concurrency: int = 2,
+                   requests_per_second: float = 1., max_retries: int = 5,
+                   backoff: float = 1.) -> Dict[str, dict]:
+    """
+    downloads many users at the same time over one pooled session, under a global concurrency and request rate
+    each response is appended to that users store while it streams in, a user that fails doesn't stop the others
+    lichess throttles by ip, so keep max_concurrency and requests_per_second low against lichess.org
+    :param base_url: defaults to LICHESS_API_URL, can point to a local server that serves ndjson
+    :return: per user stats: games, bytes, attempts, seconds, games_per_second and error (None when it succeeded)
+    """
+    userids = list(userids)
+    rate_limiter = RateLimiter(requests_per_second, burst=max_concurrency)
+    all_stats: Dict[str, dict] = {}
+    start = time.time()
+
+    def run(userid):
+        try:
+            stats = download_user(userid, download, base_url=base_url, session=session, rate_limiter=rate_limiter,
+                                  max_retries=max_retries, backoff=backoff)
+        except Exception as e:
+            logger.exception(f"failed downloading {userid}")
+            stats = {'games': 0, 'bytes': 0, 'attempts': None, 'seconds': 0., 'error': repr(e)}
+        stats['games_per_second'] = stats['games'] / stats['seconds'] if stats['seconds'] else 0.
+        logger.info(f"downloaded {stats['games']} games ({stats['bytes'] / 1e6:.2f} MB) for {userid} "
+                    f"in {stats['seconds']:.1f} seconds, {stats['games_per_second']:.1f} games/sec")
+        all_stats[userid] = stats
+
+    with make_session(max_concurrency) as session, ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        list(executor.map(run, userids))
+    total_games = sum(stats['games'] for stats in all_stats.values())
+    elapsed = time.time() - start
+    logger.info(f"downloaded {total_games} games for {len(userids)} users in {elapsed:.1f} seconds")
+    return {userid: all_stats[userid] for userid in userids}
@@ -0,0 +1,109 @@
+from typing import Dict, List, Union
+import logging
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import chess
+import chess.engine
+
+logger = logging.getLogger(__name__)
+
+# what a mate counts as when it is combined with centipawn scores
+MATE_SCORE = 10_000
+COMBINE_METHODS = {
+    'mean': statistics.mean,
+    'median': statistics.median
+}
+
+
+def combine_scores(scores: List[chess.engine.Score], method: str = 'mean') -> chess.engine.Score:
+    """
+    combines scores from the same point of view, if every engine sees a mate for the same side the quickest one
+    is kept, otherwise mates count as +-MATE_SCORE centipawns
+    """
+    mates = [score.mate() for score in scores if score.is_mate()]
+    if len(mates) == len(scores):
+        if all(mate > 0 for mate in mates):
+            return chess.engine.Mate(min(mates))
+        if all(mate < 0 for mate in mates):
+            return chess.engine.Mate(max(mates))
+        if all(mate == 0 for mate in mates):
+            return chess.engine.MateGiven
+    cps = [score.score(mate_score=MATE_SCORE) for score in scores]
+    return chess.engine.Cp(int(round(COMBINE_METHODS[method](cps))))
+
+
+def format_ensemble_comment(scores: List[chess.engine.Score]) -> str:
+    cps = [score.score(mate_score=MATE_SCORE) for score in scores]
+    values = ",".join(str(score) if score.is_mate() else f"{score.score() / 100.:+}" for score in scores)
+    return f"[%evals {values}] [%evalspread {(max(cps) - min(cps)) / 100.}]"
+
+
+def quit_engine(engine: chess.engine.SimpleEngine):
+    """
+    quits the engine, or only closes its pipes when its process already died, ie: after an EngineTerminatedError
+    """
+    try:
+        engine.quit()
+    except chess.engine.EngineTerminatedError:
+        engine.close()
+
+
+class EngineEnsemble:
+    """
+    analyses every position on all engines at the same time and combines the scores, so it costs about as much
+    as the slowest engine instead of all of them one after the other
+    has the parts of chess.engine.SimpleEngine that analysis uses, so it can be passed anywhere an engine is
+    the info it returns has the combined "score" and a "comment" with every engine's score and their spread
+    """
+    def __init__(self, engines: List[chess.engine.SimpleEngine], method: str = 'mean'):
+        if method not in COMBINE_METHODS:
+            raise ValueError(f"method must be one of {list(COMBINE_METHODS)}, not {method}")
+        self.engines = engines
+        self.method = method
+        self.id = {'name': f"ensemble[{method}]({','.join(engine.id.get('name', '') for engine in engines)})"}
+        self._executor = ThreadPoolExecutor(max_workers=len(engines), thread_name_prefix='ensemble-engine')
+
+    @classmethod
+    def popen_uci(cls, engine_paths: List[str], engine_options: Dict[str, Union[str, int, bool]] = None,
+                  method: str = 'mean') -> 'EngineEnsemble':
+        engines = []
+        try:
+            for engine_path in engine_paths:
+                engine = chess.engine.SimpleEngine.popen_uci(engine_path)
+                engines.append(engine)
+                if engine_options:
+                    engine.configure(engine_options)
+        except Exception:
+            for engine in engines:
+                engine.quit()
+            raise
+        return cls(engines, method=method)
+
+    def configure(self, options: Dict[str, Union[str, int, bool]]):
+        for engine in self.engines:
+            engine.configure(options)
+
+    def analyse(self, board: chess.Board, limit: chess.engine.Limit, **kwargs) -> dict:
+        futures = [self._executor.submit(engine.analyse, board, limit, **kwargs) for engine in self.engines]
+        infos = [future.result() for future in futures]
+        scores = [info['score'].pov(chess.WHITE) for info in infos]
+        return {
+            'score': chess.engine.PovScore(combine_scores(scores, self.method), chess.WHITE),
+            'comment': format_ensemble_comment(scores),
+            'infos': infos
+        }
+
+    def quit(self):
+        self._executor.shutdown()
+        for engine in self.engines:
+            quit_engine(engine)
+
+    def close(self):
+        self.quit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.quit()
@@ -0,0 +1,149 @@
+from typing import Dict, Union
+import hashlib
+import json
+import os
+import logging
+import sqlite3
+import threading
+import time
+
+import chess
+import chess.engine
+
+from metrics import METRICS
+
+DATA_FOLDER = 'data'
+DEFAULT_CACHE_NAME = 'eval_cache.sqlite'
+logger = logging.getLogger(__name__)
+
+
+def get_default_cache_path():
+    return os.path.join(DATA_FOLDER, DEFAULT_CACHE_NAME)
+
+
+def position_key(board: chess.Board) -> str:
+    # epd drops the halfmove and fullmove clocks so transpositions share the same key
+    return board.epd()
+
+
+def limit_key(limit: chess.engine.Limit, engine_name: str = "") -> str:
+    return f"{engine_name}|time={limit.time}|depth={limit.depth}|nodes={limit.nodes}"
+
+
+def engine_identity(engine_name: str, engine_options: Dict[str, Union[str, int, bool]] = None) -> str:
+    """
+    the engine_name of limit_key, the uci name the engine reports plus a hash of the uci options it was given
+    """
+    if not engine_options:
+        return engine_name
+    options = json.dumps(sorted(engine_options.items()), default=str).encode('utf8')
+    return f"{engine_name}#{hashlib.blake2b(options, digest_size=4).hexdigest()}"
+
+
+class EvalCache:
+    """
+    on disk cache of white pov engine scores keyed by position and analysis limit, shared across games and runs
+    evicts the least recently used positions once there are more than max_entries
+    """
+    def __init__(self, path: str = None, max_entries: Union[int, None] = 1_000_000, commit_every: int = 100):
+        self.path = path or get_default_cache_path()
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self._pending_writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS evals ("
+            "position TEXT NOT NULL, limit_key TEXT NOT NULL, cp INTEGER, mate INTEGER, last_used REAL NOT NULL, "
+            "PRIMARY KEY (position, limit_key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS evals_last_used ON evals (last_used)")
+        # the identity every engine binary had when it last ran, see add_chess_analysis.LazyEngine
+        self._conn.execute("CREATE TABLE IF NOT EXISTS engines (binary TEXT PRIMARY KEY, identity TEXT NOT NULL)")
+        self._conn.commit()
+
+    def get_engine_identity(self, binary: str) -> Union[str, None]:
+        with self._lock:
+            row = self._conn.execute("SELECT identity FROM engines WHERE binary = ?", (binary,)).fetchone()
+        return row[0] if row is not None else None
+
+    def put_engine_identity(self, binary: str, identity: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO engines (binary, identity) VALUES (?, ?)", (binary, identity))
+            self._conn.commit()
+
+    def get(self, board: chess.Board, key: str) -> Union[chess.engine.Score, None]:
+        position = position_key(board)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT cp, mate FROM evals WHERE position = ? AND limit_key = ?", (position, key)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                METRICS.inc('eval_cache_misses_total')
+                return None
+            self.hits += 1
+            METRICS.inc('eval_cache_hits_total')
+            self._conn.execute(
+                "UPDATE evals SET last_used = ? WHERE position = ? AND limit_key = ?", (time.time(), position, key)
+            )
+            self._maybe_commit()
+        cp, mate = row
+        if mate is None:
+            return chess.engine.Cp(cp)
+        if mate == 0:
+            return chess.engine.MateGiven
+        return chess.engine.Mate(mate)
+
+    def put(self, board: chess.Board, key: str, score_from_white: chess.engine.Score):
+        if score_from_white.is_mate():
+            cp, mate = None, score_from_white.mate()
+        else:
+            cp, mate = score_from_white.score(), None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO evals (position, limit_key, cp, mate, last_used) VALUES (?, ?, ?, ?, ?)",
+                (position_key(board), key, cp, mate, time.time())
+            )
+            self._maybe_commit()
+
+    def _maybe_commit(self):
+        self._pending_writes += 1
+        if self._pending_writes >= self.commit_every:
+            self._commit()
+
+    def _commit(self):
+        if self.max_entries is not None:
+            self._evict()
+        self._conn.commit()
+        self._pending_writes = 0
+
+    def _evict(self):
+        (total,) = self._conn.execute("SELECT COUNT(*) FROM evals").fetchone()
+        if total <= self.max_entries:
+            return
+        self._conn.execute(
+            "DELETE FROM evals WHERE rowid IN (SELECT rowid FROM evals ORDER BY last_used LIMIT ?)",
+            (total - self.max_entries,)
+        )
+        logger.debug(f"evicted {total - self.max_entries} positions from the eval cache")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM evals").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._conn.close()
+        logger.info(f"eval cache had {self.hits} hits and {self.misses} misses")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+a stand-in uci engine for benchmarks, it answers every `go` with a scripted eval after a fixed latency
+the eval of a position is read from EvalFile when it is there, otherwise it is derived from a hash of the position,
+so the same position always gets the same eval on every run
+uci options:
+    Latency: milliseconds to wait before answering each `go`
+    Depth / Nodes: reported in the info line
+    EvalFile: json file of {epd: centipawns from white's point of view, or "#3" / "#-3" for mates}
+"""
+import hashlib
+import json
+import sys
+import time
+
+import chess
+
+OPTIONS = {
+    'Latency': ('spin', 0, 0, 60_000),
+    'Depth': ('spin', 12, 1, 100),
+    'Nodes': ('spin', 100_000, 1, 10 ** 9),
+    'Hash': ('spin', 16, 1, 65536),
+    'Threads': ('spin', 1, 1, 512),
+}
+
+
+def _out(line: str):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+
+def hashed_eval(board: chess.Board) -> int:
+    """
+    centipawns from white's point of view, between -300 and 300
+    """
+    return int(hashlib.md5(board.epd().encode()).hexdigest(), 16) % 601 - 300
+
+
+def _parse_position(tokens) -> chess.Board:
+    if tokens[1] == 'startpos':
+        board = chess.Board()
+        rest = tokens[2:]
+    else:
+        moves_at = tokens.index('moves') if 'moves' in tokens else len(tokens)
+        board = chess.Board(' '.join(tokens[2:moves_at]))
+        rest = tokens[moves_at:]
+    if rest and rest[0] == 'moves':
+        for uci in rest[1:]:
+            board.push_uci(uci)
+    return board
+
+
+def _score(board: chess.Board, scripted: dict) -> str:
+    if board.is_checkmate():
+        return 'mate 0'
+    if board.is_game_over():
+        return 'cp 0'
+    value = scripted.get(board.epd())
+    if value is None:
+        cp = hashed_eval(board)
+    elif isinstance(value, str) and value.startswith('#'):
+        mate = int(value[1:])
+        # uci scores are from the side to move
+        return f"mate {mate if board.turn == chess.WHITE else -mate}"
+    else:
+        cp = int(value)
+    return f"cp {cp if board.turn == chess.WHITE else -cp}"
+
+
+def main():
+    options = {name: default for name, (_, default, _, _) in OPTIONS.items()}
+    scripted = {}
+    board = chess.Board()
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+        if command == 'uci':
+            _out('id name FakeUciEngine')
+            _out('id author benchmark')
+            for name, (kind, default, low, high) in OPTIONS.items():
+                _out(f'option name {name} type {kind} default {default} min {low} max {high}')
+            _out('option name EvalFile type string default <empty>')
+            _out('uciok')
+        elif command == 'isready':
+            _out('readyok')
+        elif command == 'setoption':
+            name = ' '.join(tokens[2:tokens.index('value')]) if 'value' in tokens else ' '.join(tokens[2:])
+            value = ' '.join(tokens[tokens.index('value') + 1:]) if 'value' in tokens else ''
+            if name == 'EvalFile':
+                scripted = {}
+                if value and value != '<empty>':
+                    with open(value) as f:
+                        scripted = json.load(f)
+            elif name in OPTIONS:
+                options[name] = int(value)
+        elif command == 'ucinewgame':
+            board = chess.Board()
+        elif command == 'position':
+            board = _parse_position(tokens)
+        elif command == 'go':
+            time.sleep(options['Latency'] / 1000.)
+            move = next(iter(board.legal_moves), None)
+            pv = f" pv {move.uci()}" if move is not None else ""
+            latency = max(options['Latency'], 1)
+            _out(f"info depth {options['Depth']} nodes {options['Nodes']} nps {options['Nodes'] * 1000 // latency} "
+                 f"score {_score(board, scripted)}{pv}")
+            _out(f"bestmove {move.uci() if move is not None else '(none)'}")
+        elif command == 'quit':
+            break
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,299 @@
+from typing import Callable, Iterable, Union
+import re
+
+SPEED_PERF_TYPES = frozenset(('ultraBullet', 'bullet', 'blitz', 'rapid', 'classical', 'correspondence'))
+VARIANT_PERF_TYPES = frozenset(
+    ('chess960', 'crazyhouse', 'antichess', 'atomic', 'horde', 'kingOfTheHill', 'racingKings', 'threeCheck')
+)
+
+_RATED_REGEX = re.compile(rb'"rated":\s*(true|false)')
+_VARIANT_REGEX = re.compile(rb'"variant":\s*"(\w+)"')
+_SPEED_REGEX = re.compile(rb'"speed":\s*"(\w+)"')
+_CREATED_AT_REGEX = re.compile(rb'"createdAt":\s*(\d+)')
+
+
+class Filter:
+    """
+    a filter returns True for a game that should be skipped, ie: `filter_if_not_rated_game()(game_json)`
+    on top of that a filter knows how to narrow the lichess export query so skipped games aren't downloaded at all,
+    and how to skip a game from its raw ndjson line before it is json decoded, see `api_params` and `skips_raw`
+    both are only shortcuts, a game that gets through them is still checked with the filter itself
+    plain functions still work as filters everywhere, they just can't take those shortcuts
+    :param cost: how expensive the raw check is, combined filters try the cheapest first
+    """
+    cost = 10
+
+    def __init__(self, predicate: Callable[[dict], bool]):
+        self.predicate = predicate
+
+    def __call__(self, game_json: dict) -> bool:
+        return self.predicate(game_json)
+
+    def constraints(self) -> dict:
+        """
+        what every game this filter keeps has in common, in lichess export terms
+        perfType is a set of the perf types a kept game can have, rated a bool, vs a user id, since / until in ms
+        """
+        return {}
+
+    def check_raw(self, line: bytes) -> Union[bool, None]:
+        """
+        :return: whether to skip the game from its ndjson line, or None when it can't tell without decoding it
+        """
+        return None
+
+
+def _as_filter(game_filter: Callable[[dict], bool]) -> Filter:
+    return game_filter if isinstance(game_filter, Filter) else Filter(game_filter)
+
+
+class _Any(Filter):
+    # skips a game when any of the filters would
+    def __init__(self, filters: Iterable[Callable[[dict], bool]]):
+        self.filters = sorted((_as_filter(f) for f in filters), key=lambda f: f.cost)
+        self.cost = max((f.cost for f in self.filters), default=0)
+
+    def __call__(self, game_json: dict) -> bool:
+        return any(f(game_json) for f in self.filters)
+
+    def constraints(self) -> dict:
+        # a kept game passes every filter, so it has every filter's constraints
+        merged = {}
+        for f in self.filters:
+            for key, value in f.constraints().items():
+                if key not in merged:
+                    merged[key] = value
+                elif key == 'perfType':
+                    merged[key] = merged[key] & value
+                elif key == 'since':
+                    merged[key] = max(merged[key], value)
+                elif key == 'until':
+                    merged[key] = min(merged[key], value)
+                elif merged[key] != value:
+                    # contradicting filters keep no game, the filters themselves will skip them all
+                    merged[key] = None
+        return {key: value for key, value in merged.items() if value is not None}
+
+    def check_raw(self, line: bytes) -> Union[bool, None]:
+        result = False
+        for f in self.filters:
+            skip = f.check_raw(line)
+            if skip:
+                return True
+            if skip is None:
+                result = None
+        return result
+
+
+class _All(Filter):
+    # skips a game only when every filter would
+    def __init__(self, filters: Iterable[Callable[[dict], bool]]):
+        self.filters = sorted((_as_filter(f) for f in filters), key=lambda f: f.cost)
+        self.cost = max((f.cost for f in self.filters), default=0)
+
+    def __call__(self, game_json: dict) -> bool:
+        return all(f(game_json) for f in self.filters)
+
+    def constraints(self) -> dict:
+        # a kept game only has to pass one of the filters, so nothing is common unless there is a single one
+        return self.filters[0].constraints() if len(self.filters) == 1 else {}
+
+    def check_raw(self, line: bytes) -> Union[bool, None]:
+        result = True
+        for f in self.filters:
+            skip = f.check_raw(line)
+            if skip is False:
+                return False
+            if skip is None:
+                result = None
+        return result
+
+
 def AND(*filters):
-    return lambda game: all(
-        f(game) for f in filters
-    )
+    return _All(filters)
 
 
 def OR(*filters):
-    return lambda game: any(
-        f(game) for f in filters
-    )
+    return _Any(filters)
+
+
+class _PlayedAgainstAI(Filter):
+    cost = 1
+
+    def __init__(self):
+        super().__init__(
+            lambda game_json: 'aiLevel' in game_json['players']['white'] or 'aiLevel' in game_json['players']['black']
+        )
+
+    def check_raw(self, line: bytes) -> Union[bool, None]:
+        return b'"aiLevel"' in line
 
 
 def filter_if_played_against_ai():
-    return lambda game_json: 'aiLevel' in game_json['players']['white'] or 'aiLevel' in game_json['players']['black']
+    return _PlayedAgainstAI()
+
+
+class _AnonymousPlayer(Filter):
+    cost = 3
+
+    def __init__(self):
+        super().__init__(
+            lambda game_json: 'user' not in game_json['players']['white'] or 'user' not in game_json['players']['black']
+        )
+
+    def check_raw(self, line: bytes) -> Union[bool, None]:
+        # both players have a "user", anything else has to be decoded to be sure
+        return False if line.count(b'"user"') >= 2 else None
 
 
 def filter_if_anonymous_player():
-    return lambda game_json: 'user' not in game_json['players']['white'] or 'user' not in game_json['players']['white']
+    return _AnonymousPlayer()
+
+
+def _check_raw_value(regex: re.Pattern, line: bytes, skip: Callable[[str], bool]) -> Union[bool, None]:
+    match = regex.search(line)
+    return None if match is None else skip(match.group(1).decode())
+
+
+class _VariantNotIn(Filter):
+    cost = 2
+
+    def __init__(self, variants):
+        self.variants = set(variants)
+        super().__init__(lambda game_json: game_json['variant'] not in self.variants)
+
+    def constraints(self) -> dict:
+        perf_types = set()
+        for variant in self.variants:
+            if variant == 'standard':
+                perf_types |= SPEED_PERF_TYPES
+            elif variant in VARIANT_PERF_TYPES:
+                perf_types.add(variant)
+            else:
+                # ie: fromPosition has no perf type to ask for
+                return {}
+        return {'perfType': perf_types}
+
+    def check_raw(self, line: bytes) -> Union[bool, None]:
+        return _check_raw_value(_VARIANT_REGEX, line, lambda variant: variant not in self.variants)
 
 
 def filter_if_variant_is_not_in(*args):
-    return lambda game_json: any(game_json['variant'] == arg for arg in args)
+    return _VariantNotIn(args)
+
+
+class _SpeedNotIn(Filter):
+    cost = 2
+
+    def __init__(self, speeds):
+        self.speeds = set(speeds)
+        super().__init__(lambda game_json: game_json['speed'] not in self.speeds)
+
+    def constraints(self) -> dict:
+        # games of other variants have the variant as their perf type whatever their speed
+        return {'perfType': (self.speeds & SPEED_PERF_TYPES) | VARIANT_PERF_TYPES}
+
+    def check_raw(self, line: bytes) -> Union[bool, None]:
+        return _check_raw_value(_SPEED_REGEX, line, lambda speed: speed not in self.speeds)
+
+
+def filter_if_speed_is_not_in(*args):
+    return _SpeedNotIn(args)
+
+
+class _NotRated(Filter):
+    cost = 2
+
+    def __init__(self):
+        super().__init__(lambda game_json: not game_json['rated'])
+
+    def constraints(self) -> dict:
+        return {'rated': True}
+
+    def check_raw(self, line: bytes) -> Union[bool, None]:
+        return _check_raw_value(_RATED_REGEX, line, lambda rated: rated == 'false')
 
 
 def filter_if_not_rated_game():
-    return lambda game_json: not game_json['rated']
+    return _NotRated()
+
+
+class _NotAgainst(Filter):
+    def __init__(self, opponent: str):
+        self.opponent = opponent.lower()
+        super().__init__(lambda game_json: all(
+            game_json['players'][color].get('user', {}).get('id') != self.opponent for color in ('white', 'black')
+        ))
+
+    def constraints(self) -> dict:
+        return {'vs': self.opponent}
+
+
+def filter_if_not_played_against(opponent: str):
+    return _NotAgainst(opponent)
+
+
+class _CreatedOutside(Filter):
+    cost = 3
+
+    def __init__(self, since: Union[int, None], until: Union[int, None]):
+        self.since = since
+        self.until = until
+        super().__init__(lambda game_json: self._skip(game_json['createdAt']))
+
+    def _skip(self, created_at: int) -> bool:
+        return (self.since is not None and created_at < self.since) or \
+            (self.until is not None and created_at > self.until)
+
+    def constraints(self) -> dict:
+        constraints = {}
+        if self.since is not None:
+            constraints['since'] = self.since
+        if self.until is not None:
+            constraints['until'] = self.until
+        return constraints
+
+    def check_raw(self, line: bytes) -> Union[bool, None]:
+        return _check_raw_value(_CREATED_AT_REGEX, line, lambda created_at: self._skip(int(created_at)))
+
+
+def filter_if_played_before(timestamp: int):
+    """
+    :param timestamp: in ms, like `createdAt`
+    """
+    return _CreatedOutside(since=timestamp, until=None)
+
+
+def filter_if_played_after(timestamp: int):
+    """
+    :param timestamp: in ms, like `createdAt`
+    """
+    return _CreatedOutside(since=None, until=timestamp)
+
+
+def api_params(game_filter: Union[Callable[[dict], bool], None]) -> dict:
+    """
+    lichess export parameters that leave out games the filter would skip anyway
+    """
+    if game_filter is None:
+        return {}
+    params = {}
+    for key, value in _as_filter(game_filter).constraints().items():
+        if key == 'perfType':
+            if value:
+                params[key] = ','.join(sorted(value))
+        elif key == 'rated':
+            params[key] = 'true' if value else 'false'
+        else:
+            params[key] = value
+    return params
+
+
+def skips_raw(game_filter: Union[Callable[[dict], bool], None], line: bytes) -> bool:
+    """
+    whether the game on this ndjson line is skipped, only True when that is certain without decoding the whole line
+    """
+    if game_filter is None:
+        return False
+    return bool(_as_filter(game_filter).check_raw(line))
+
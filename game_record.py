@@ -0,0 +1,220 @@
+from typing import Dict, List, Union
+import io
+import math
+
+import numpy as np
+import chess
+import chess.pgn
+import chess.engine
+
+from add_chess_analysis import format_score
+
+
+def parse_eval(comment: str) -> Union[chess.engine.Score, None]:
+    """
+    white's point of view score of a `[%eval ...]` comment, like chess.pgn.GameNode.eval without needing the node
+    """
+    match = chess.pgn.EVAL_REGEX.search(comment)
+    if not match:
+        return None
+    if match.group("mate"):
+        return chess.engine.Mate(int(match.group("mate")))
+    return chess.engine.Cp(round(float(match.group("cp")) * 100))
+
+
+def parse_clock(comment: str) -> Union[float, None]:
+    match = chess.pgn.CLOCK_REGEX.search(comment)
+    if not match:
+        return None
+    return int(match.group("hours")) * 3600 + int(match.group("minutes")) * 60 + float(match.group("seconds"))
+
+
+def pack_move(move: chess.Move) -> int:
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+
+def unpack_move(packed: int) -> chess.Move:
+    promotion = (packed >> 12) & 0x7
+    return chess.Move(packed & 0x3F, (packed >> 6) & 0x3F, promotion=promotion or None)
+
+
+class GameRecord:
+    """
+    a game's mainline as flat arrays instead of a tree of chess.pgn.GameNode
+    `moves[i]` is the (packed) move of ply i + 1, the per position arrays have one more entry,
+    index 0 is the starting position and index i the position after ply i, the same numbering analysis_utils uses
+    evals are from white's point of view: `evals` has the centipawns, or the moves to mate when `is_mate`
+    only the mainline, evals and clocks are kept, other comments and variations are dropped
+    `moves` is None when the record was read without its moves (see EvalsOnlyRecordVisitor)
+    """
+    __slots__ = ('headers', 'moves', 'evals', 'is_mate', 'has_eval', 'clocks')
+
+    def __init__(self, headers: Dict[str, str], moves: np.ndarray, evals: np.ndarray, is_mate: np.ndarray,
+                 has_eval: np.ndarray, clocks: np.ndarray):
+        self.headers = headers
+        self.moves = moves  # uint16 or None
+        self.evals = evals  # int32
+        self.is_mate = is_mate  # bool
+        self.has_eval = has_eval  # bool
+        self.clocks = clocks  # float32 seconds left, nan when missing
+
+    @classmethod
+    def empty(cls, headers: Dict[str, str], num_plies: int, with_moves: bool = True) -> 'GameRecord':
+        return cls(
+            headers=headers,
+            moves=np.zeros(num_plies, dtype=np.uint16) if with_moves else None,
+            evals=np.zeros(num_plies + 1, dtype=np.int32),
+            is_mate=np.zeros(num_plies + 1, dtype=bool),
+            has_eval=np.zeros(num_plies + 1, dtype=bool),
+            clocks=np.full(num_plies + 1, np.nan, dtype=np.float32)
+        )
+
+    def set_eval(self, i: int, score_from_white: Union[chess.engine.Score, None]):
+        if score_from_white is None:
+            return
+        self.has_eval[i] = True
+        self.is_mate[i] = score_from_white.is_mate()
+        self.evals[i] = score_from_white.mate() if score_from_white.is_mate() else score_from_white.score()
+
+    @classmethod
+    def from_game(cls, game: chess.pgn.Game) -> 'GameRecord':
+        nodes = [game]
+        while len(nodes[-1].variations):
+            nodes.append(nodes[-1].variations[0])
+        record = cls.empty(dict(game.headers), len(nodes) - 1)
+        for i, node in enumerate(nodes):
+            if i != 0:
+                record.moves[i - 1] = pack_move(node.move)
+            pov_score = node.eval()
+            if pov_score is not None:
+                record.set_eval(i, pov_score.pov(chess.WHITE))
+            clock = node.clock()
+            if clock is not None:
+                record.clocks[i] = clock
+        return record
+
+    def __len__(self):
+        """
+        number of plies
+        """
+        return len(self.evals) - 1
+
+    @property
+    def num_plies(self) -> int:
+        return len(self.evals) - 1
+
+    def _check_moves(self):
+        if self.moves is None:
+            raise ValueError(f"{self.headers.get('ID')} was read without its moves")
+
+    def score(self, i: int) -> Union[chess.engine.Score, None]:
+        """
+        white's point of view score of the position after ply i
+        """
+        if not self.has_eval[i]:
+            return None
+        if self.is_mate[i]:
+            mate = int(self.evals[i])
+            return chess.engine.MateGiven if mate == 0 else chess.engine.Mate(mate)
+        return chess.engine.Cp(int(self.evals[i]))
+
+    def eval(self, i: int) -> Union[chess.engine.PovScore, None]:
+        """
+        same as `get_move(game, i).eval()`
+        """
+        score = self.score(i)
+        return None if score is None else chess.engine.PovScore(score, chess.WHITE)
+
+    def clock(self, i: int) -> Union[float, None]:
+        return None if math.isnan(self.clocks[i]) else float(self.clocks[i])
+
+    def starting_board(self) -> chess.Board:
+        if 'FEN' in self.headers:
+            return chess.Board(self.headers['FEN'])
+        return chess.Board()
+
+    def board(self, i: int) -> chess.Board:
+        """
+        the position after ply i
+        """
+        self._check_moves()
+        board = self.starting_board()
+        for packed in self.moves[:i]:
+            board.push(unpack_move(int(packed)))
+        return board
+
+    def to_game(self) -> chess.pgn.Game:
+        self._check_moves()
+        game = chess.pgn.Game(headers=self.headers)
+        node = game
+        for i in range(self.num_plies + 1):
+            if i != 0:
+                node = node.add_variation(unpack_move(int(self.moves[i - 1])))
+            score = self.score(i)
+            if score is not None:
+                node.comment += f'[%eval {format_score(score)}]'
+            clock = self.clock(i)
+            if clock is not None:
+                node.set_clock(clock)
+        return game
+
+
+class RecordVisitor(chess.pgn.BaseVisitor):
+    """
+    builds a GameRecord straight from pgn text, ie: `chess.pgn.read_game(pgn, Visitor=RecordVisitor)`
+    without ever building the GameNode tree, variations are skipped
+    """
+    with_moves = True
+
+    def begin_game(self):
+        self.headers: Dict[str, str] = {}
+        self.moves: List[int] = []
+        self.num_plies = 0
+        self.evals: Dict[int, chess.engine.Score] = {}
+        self.clocks: Dict[int, float] = {}
+
+    def visit_header(self, tagname: str, tagvalue: str):
+        self.headers[tagname] = tagvalue
+
+    def visit_move(self, board: chess.Board, move: chess.Move):
+        self.moves.append(pack_move(move))
+        self.num_plies += 1
+
+    def visit_comment(self, comment: str):
+        # a comment belongs to the position after the last move
+        score = parse_eval(comment)
+        if score is not None:
+            self.evals[self.num_plies] = score
+        clock = parse_clock(comment)
+        if clock is not None:
+            self.clocks[self.num_plies] = clock
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def result(self) -> GameRecord:
+        record = GameRecord.empty(self.headers, self.num_plies, with_moves=self.with_moves)
+        if self.with_moves:
+            record.moves[:] = self.moves
+        for i, score in self.evals.items():
+            record.set_eval(i, score)
+        for i, clock in self.clocks.items():
+            record.clocks[i] = clock
+        return record
+
+
+class EvalsOnlyRecordVisitor(RecordVisitor):
+    """
+    only counts the moves instead of parsing them, which is most of the work of reading a game,
+    enough for metrics that only need evals and clocks
+    """
+    with_moves = False
+
+    def begin_parse_san(self, board: chess.Board, san: str):
+        self.num_plies += 1
+        return chess.pgn.SKIP
+
+
+def read_record(pgn: str, with_moves: bool = True) -> Union[GameRecord, None]:
+    visitor = RecordVisitor if with_moves else EvalsOnlyRecordVisitor
+    return chess.pgn.read_game(io.StringIO(pgn), Visitor=visitor)
@@ -0,0 +1,271 @@
+from typing import Callable, Dict, Iterable, Iterator, List, Union
+import hashlib
+import io
+import os
+import json
+import logging
+import threading
+
+import chess.pgn
+
+logger = logging.getLogger(__name__)
+
+DATA_FOLDER = 'data'
+DATA_SUFFIX = '.pgn'
+INDEX_SUFFIX = '.index.jsonl'
+
+
+def get_path_to_user_id_games(userid, analysis_time):
+    analysis_prefix = "no" if analysis_time is None else str(analysis_time)
+    return os.path.join(DATA_FOLDER, f'{userid}.python_chess.{analysis_prefix}_analysis')
+
+
+def pgn_hash(pgn: Union[str, bytes]) -> str:
+    """
+    kept in every index entry, so what changed between two versions of a store is known without reading the pgns
+    """
+    return hashlib.blake2b(pgn.encode('utf8') if isinstance(pgn, str) else pgn, digest_size=16).hexdigest()
+
+
+def get_game_id(game: chess.pgn.Game) -> str:
+    if 'ID' in game.headers:
+        return game.headers['ID']
+    # only games converted before the ID header need it, which keeps this module light for main.py's stats
+    from lichess_to_python_chess import site_to_id
+    return site_to_id(game.headers['Site'])
+
+
+class GameStore:
+    """
+    games saved as pgn text one after another, plus an index with every game's id, headers and byte offset
+    only the index is loaded when opening, a game is parsed when it is accessed
+    appending a game with an id that is already stored replaces it, the old pgn stays in the file until `compact`
+    or `compact_if_needed`
+    """
+    def __init__(self, path: str):
+        """
+        :param path: path without suffix, the store is `path + DATA_SUFFIX` and `path + INDEX_SUFFIX`
+        """
+        self.path = path
+        self.data_path = path + DATA_SUFFIX
+        self.index_path = path + INDEX_SUFFIX
+        self._lock = threading.Lock()
+        self._entries: Dict[str, dict] = {}
+        self._order: List[str] = []
+        self._live_bytes = 0
+        self._recover()
+        self._load_index()
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(path + INDEX_SUFFIX)
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        with open(self.index_path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    logger.warning(f"skipping partially written index entry at the end of {self.index_path}")
+                    break
+                entry = json.loads(line)
+                if entry['offset'] + entry['length'] > data_size:
+                    logger.warning(f"skipping {entry['id']} in {self.index_path}, its pgn was never fully written")
+                    continue
+                self._add_entry(entry)
+
+    def _add_entry(self, entry: dict):
+        if entry['id'] not in self._entries:
+            self._order.append(entry['id'])
+        else:
+            self._live_bytes -= self._entries[entry['id']]['length']
+        self._entries[entry['id']] = entry
+        self._live_bytes += entry['length']
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, game_id: str):
+        return game_id in self._entries
+
+    def ids(self) -> List[str]:
+        return list(self._order)
+
+    def headers(self, game_id: str) -> Dict[str, str]:
+        return self._entries[game_id]['headers']
+
+    def entry(self, game_id: str) -> dict:
+        return self._entries[game_id]
+
+    def read_pgn(self, game_id: str) -> str:
+        entry = self._entries[game_id]
+        with self._lock, open(self.data_path, 'rb') as f:
+            f.seek(entry['offset'])
+            return f.read(entry['length']).decode('utf8')
+
+    def get(self, game_id: str) -> chess.pgn.Game:
+        return chess.pgn.read_game(io.StringIO(self.read_pgn(game_id)))
+
+    def __getitem__(self, key: Union[int, str]) -> chess.pgn.Game:
+        """
+        by position, in the order the games were first saved, or by lichess id
+        """
+        if isinstance(key, str):
+            return self.get(key)
+        return self.get(self._order[key])
+
+    def __iter__(self) -> Iterator[chess.pgn.Game]:
+        for game_id in self.ids():
+            yield self.get(game_id)
+
+    def select(self, predicate: Callable[[Dict[str, str]], bool]) -> Iterator[chess.pgn.Game]:
+        """
+        parses only the games whose headers match, ie: `store.select(lambda h: h['Speed'] == 'blitz')`
+        """
+        for game_id in self.ids():
+            if predicate(self._entries[game_id]['headers']):
+                yield self.get(game_id)
+
+    def append(self, game: chess.pgn.Game, **metadata):
+        self.extend([game], **metadata)
+
+    def replace(self, game: chess.pgn.Game, **metadata):
+        """
+        appends the game over its stored version, keeping the metadata of the stored version that isn't given
+        """
+        game_id = get_game_id(game)
+        kept = {}
+        if game_id in self._entries:
+            kept = {key: value for key, value in self._entries[game_id].items()
+                    if key not in ('id', 'offset', 'length', 'headers')}
+        self.extend([game], **{**kept, **metadata})
+
+    def extend(self, games: Iterable[chess.pgn.Game], **metadata):
+        """
+        :param metadata: saved in the index entry of every game next to its headers
+        """
+        os.makedirs(os.path.dirname(self.data_path) or '.', exist_ok=True)
+        with self._lock, open(self.data_path, 'ab') as data_file, open(self.index_path, 'ab') as index_file:
+            offset = data_file.tell()
+            for game in games:
+                pgn = (str(game) + '\n\n').encode('utf8')
+                data_file.write(pgn)
+                entry = {
+                    'id': get_game_id(game),
+                    'offset': offset,
+                    'length': len(pgn),
+                    'headers': dict(game.headers),
+                    **metadata,
+                    'pgn_hash': pgn_hash(pgn)
+                }
+                # the pgn is flushed before its index entry, so the index never points past the data
+                data_file.flush()
+                index_file.write((json.dumps(entry) + '\n').encode('utf8'))
+                index_file.flush()
+                offset += len(pgn)
+                self._add_entry(entry)
+
+    def flush(self):
+        """
+        makes everything appended so far durable
+        """
+        with self._lock:
+            for path in (self.data_path, self.index_path):
+                if os.path.exists(path):
+                    with open(path, 'rb+') as f:
+                        os.fsync(f.fileno())
+
+    def rewrite(self, games: Iterable[chess.pgn.Game]):
+        """
+        replaces the whole store with "games", the old store is kept until the new one is fully written
+        """
+        new_store = self.new_store_aside()
+        new_store.extend(games)
+        new_store.flush()
+        self.replace_with(new_store)
+
+    def garbage_bytes(self) -> int:
+        """
+        size of the pgns of replaced games still in the data file
+        """
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        return max(data_size - self._live_bytes, 0)
+
+    def compact_if_needed(self, max_garbage_ratio: float = 0.5) -> bool:
+        """
+        compacts once replaced games take more than max_garbage_ratio of the data file
+        :return: whether it compacted
+        """
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        if not data_size or self.garbage_bytes() / data_size <= max_garbage_ratio:
+            return False
+        logger.info(f"compacting {self.path}, {self.garbage_bytes() / data_size:.0%} of it are replaced games")
+        self.compact()
+        return True
+
+    def compact(self):
+        """
+        rewrites the store without the pgns of replaced games
+        """
+        new_store = self.new_store_aside()
+        for game_id in self.ids():
+            pgn = self.read_pgn(game_id)
+            entry = {key: value for key, value in self._entries[game_id].items() if key not in ('offset', 'length')}
+            new_store._append_raw(pgn, entry)
+        new_store.flush()
+        self.replace_with(new_store)
+
+    def _append_raw(self, pgn: str, entry: dict):
+        encoded = pgn.encode('utf8')
+        with self._lock, open(self.data_path, 'ab') as data_file, open(self.index_path, 'ab') as index_file:
+            entry = {**entry, 'offset': data_file.tell(), 'length': len(encoded), 'pgn_hash': pgn_hash(encoded)}
+            data_file.write(encoded)
+            data_file.flush()
+            index_file.write((json.dumps(entry) + '\n').encode('utf8'))
+            self._add_entry(entry)
+
+    def new_store_aside(self) -> 'GameStore':
+        """
+        an empty store next to this one, to fill and then swap in with `replace_with`
+        a process that dies while swapping has the swap finished when the store is opened again, see `_recover`
+        """
+        new_store = GameStore(self.path + '.tmp')
+        new_store.clear()
+        return new_store
+
+    def replace_with(self, new_store: 'GameStore'):
+        """
+        swaps new_store's files in for this store's, ie: once a store built aside with `new_store_aside` is complete
+        """
+        with self._lock:
+            # the data file goes first, once it is swapped the aside index is the only one that matches it
+            for new_path, path in ((new_store.data_path, self.data_path), (new_store.index_path, self.index_path)):
+                if os.path.exists(new_path):
+                    os.replace(new_path, path)
+                elif os.path.exists(path):
+                    os.remove(path)
+            self._entries = new_store._entries
+            self._order = new_store._order
+            self._live_bytes = new_store._live_bytes
+
+    def _recover(self):
+        # finishes a swap that died between the data file and the index, or before either when there was no store yet
+        tmp_path = self.path + '.tmp'
+        if not os.path.exists(tmp_path + INDEX_SUFFIX):
+            return
+        if os.path.exists(self.index_path) and os.path.exists(tmp_path + DATA_SUFFIX):
+            return
+        logger.warning(f"finishing an interrupted rewrite of {self.path}")
+        if os.path.exists(tmp_path + DATA_SUFFIX):
+            os.replace(tmp_path + DATA_SUFFIX, self.data_path)
+        os.replace(tmp_path + INDEX_SUFFIX, self.index_path)
+
+    def clear(self):
+        with self._lock:
+            for path in (self.data_path, self.index_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._entries = {}
+            self._order = []
+            self._live_bytes = 0
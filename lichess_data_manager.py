@@ -1,40 +1,78 @@
+import builtins
 import os
 import pickle
 import logging
+import re
 import requests
 import json
+import time
+from contextlib import contextmanager
 from functools import partial
+from typing import Callable, Iterator, Union
+
+from filter import api_params, skips_raw
+from metrics import METRICS
 
 # import berserk
 
 DATA_FOLDER = 'data'
+LICHESS_API_URL = 'https://lichess.org/api'
+# lichess writes the game's id first on every ndjson line
+_ID_REGEX = re.compile(rb'^\{\s*"id":\s*"([^"]+)"')
 logger = logging.getLogger(__name__)
 
 
-def get_games_from_lichess(userid, max=None):
+def iter_raw_games_from_lichess(userid, max=None, since=None, base_url=None, session: requests.Session = None,
+                                game_filter: Callable = None) -> Iterator[bytes]:
+    """
+    yields one ndjson line per game, oldest game first
+    :param since: only games created after this timestamp (in ms, like `createdAt`) are downloaded
+    :param base_url: defaults to LICHESS_API_URL, can point to a local server that serves ndjson
+    :param session: reuses its pooled connections instead of opening a new one
+    :param game_filter: what it can is sent as query parameters, games it surely skips from the line alone are dropped
+    """
     params = {
         'pgnInJson': 'true',
         'clocks': 'true',
         'evals': 'true',
-        'opening': 'true'
+        'opening': 'true',
+        'sort': 'dateAsc'
     }
     if max:
         params['max'] = int(max)
+    params.update(api_params(game_filter))
+    if since is not None:
+        # the `max` parameter hides the builtin
+        params['since'] = builtins.max(int(since), params.get('since', 0))
     headers = {'Accept': 'application/x-ndjson'}
-    games = []
-    with requests.get(
-            url= f"https://lichess.org/api/games/user/{userid}",
+    # only the time spent waiting on lichess counts as download time, not the time the caller takes per game
+    start = time.perf_counter()
+    with (session or requests).get(
+            url=f"{base_url or LICHESS_API_URL}/games/user/{userid}",
             params=params,
             headers=headers,
             stream=True
         ) as r:
         r.raise_for_status()
         r.raw.read = partial(r.raw.read, decode_content=True)
-        for game in r.iter_lines():
-            games.append(
-                json.loads(game)
-            )
-    return games
+        for line in r.iter_lines():
+            METRICS.inc('download_seconds_total', time.perf_counter() - start)
+            METRICS.inc('bytes_downloaded_total', len(line) + 1)
+            if line and not skips_raw(game_filter, line):
+                METRICS.inc('games_downloaded_total')
+                yield line
+            elif line:
+                METRICS.inc('games_filtered_total')
+            start = time.perf_counter()
+        METRICS.inc('download_seconds_total', time.perf_counter() - start)
+
+
+def get_games_from_lichess(userid, max=None, since=None, base_url=None, game_filter: Callable = None):
+    return [
+        json.loads(line) for line in iter_raw_games_from_lichess(
+            userid, max=max, since=since, base_url=base_url, game_filter=game_filter
+        )
+    ]
 
 # def get_games_from_lichess(userid, max=None):
 #     client = berserk.Client()
@@ -42,36 +80,248 @@ def get_games_from_lichess(userid, max=None):
 
 
 def get_path_to_user_id_games(userid):
+    return os.path.join(DATA_FOLDER, userid + '.lichess.ndjson')
+
+
+def get_path_to_user_id_sync_state(userid):
+    return os.path.join(DATA_FOLDER, userid + '.lichess.state.json')
+
+
+def get_path_to_legacy_user_id_games(userid):
     return os.path.join(DATA_FOLDER, userid + '.lichess.pickle')
 
 
 def data_exists(userid):
-    return os.path.exists(get_path_to_user_id_games(userid))
+    return os.path.exists(get_path_to_user_id_games(userid)) or \
+        os.path.exists(get_path_to_legacy_user_id_games(userid))
+
+
+def _migrate_legacy_data(userid):
+    legacy_path = get_path_to_legacy_user_id_games(userid)
+    if os.path.exists(get_path_to_user_id_games(userid)) or not os.path.exists(legacy_path):
+        return
+    logger.info(f"migrating {legacy_path} to the ndjson store")
+    with open(legacy_path, 'rb') as f:
+        games = pickle.load(f)
+    # the old pickle was saved newest first, the store is kept oldest first so new games can be appended
+    games.sort(key=lambda game_json: game_json['createdAt'])
+    save_data(games, userid)
+
+
+def read_sync_state(userid) -> Union[dict, None]:
+    path = get_path_to_user_id_sync_state(userid)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    # no state file, so find the newest game in the store
+    state = None
+    for game_json in read_data(userid):
+        state = _update_sync_state(state, game_json)
+    return state
+
+
+def _update_sync_state(state: Union[dict, None], game_json: dict) -> dict:
+    if state is None:
+        state = {'createdAt': 0, 'lastMoveAt': 0}
+    return {
+        'createdAt': max(state['createdAt'], game_json['createdAt']),
+        'lastMoveAt': max(state['lastMoveAt'], game_json.get('lastMoveAt', 0))
+    }
+
+
+def _write_sync_state(userid, state):
+    path = get_path_to_user_id_sync_state(userid)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def _truncate_partial_line(path):
+    # a download that died mid-line leaves a partial game at the end, drop it so appends start on a new line
+    with open(path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        f.seek(0)
+        last_newline = f.read().rfind(b'\n')
+        f.truncate(last_newline + 1)
+
+
+def iter_appended_raw_games(raw_games, userid) -> Iterator[bytes]:
+    """
+    appends each ndjson line to the users store as it passes through, so the store is written while downloading
+    the sync state is removed while appending and rewritten once done, if the process dies without it
+    the state is rebuilt from the store on the next sync
+    the store is only created once lichess answered, so a failed first download doesn't look like a synced user
+    """
+    path = get_path_to_user_id_games(userid)
+    os.makedirs(DATA_FOLDER, exist_ok=True)
+    if os.path.exists(path):
+        _truncate_partial_line(path)
+    state = read_sync_state(userid) if os.path.exists(path) else None
+    if os.path.exists(get_path_to_user_id_sync_state(userid)):
+        os.remove(get_path_to_user_id_sync_state(userid))
+    f = None
+    try:
+        for line in raw_games:
+            if f is None:
+                f = open(path, 'ab')
+            f.write(line.rstrip(b'\n') + b'\n')
+            state = _update_sync_state(state, json.loads(line))
+            yield line
+        if f is None:
+            # a user without new games is synced too
+            f = open(path, 'ab')
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        if f is not None:
+            f.close()
+        if state is not None:
+            _write_sync_state(userid, state)
+
+
+def append_raw_games(raw_games, userid) -> int:
+    """
+    appends ndjson lines to the users store without rewriting it
+    :return: number of games appended
+    """
+    return sum(1 for _ in iter_appended_raw_games(raw_games, userid))
 
 
 def save_data(games, userid):
     path = get_path_to_user_id_games(userid)
-    games = list(games)
     os.makedirs(DATA_FOLDER, exist_ok=True)
-    with open(path, 'wb') as f:
-        pickle.dump(games, f)
+    state = None
+    with open(path, 'w') as f:
+        for game_json in games:
+            f.write(json.dumps(game_json) + '\n')
+            state = _update_sync_state(state, game_json)
+    if state is not None:
+        _write_sync_state(userid, state)
 
 
-def read_data(userid):
+def iter_raw_data(userid, game_filter: Callable = None) -> Iterator[bytes]:
+    """
+    the stored games' ndjson lines, without json decoding them
+    :param game_filter: games it surely skips from their line alone are left out
+    """
+    _migrate_legacy_data(userid)
     path = get_path_to_user_id_games(userid)
     with open(path, 'rb') as f:
-        return pickle.load(f)
+        for line in f:
+            if not line.endswith(b'\n'):
+                logger.warning(f"skipping partially written game at the end of {path}")
+                break
+            if not skips_raw(game_filter, line):
+                yield line
+
+
+def raw_game_id(line: bytes) -> str:
+    """
+    the id of the game on this ndjson line, only decodes the line when the id isn't at its start
+    """
+    match = _ID_REGEX.match(line)
+    return match.group(1).decode('utf8') if match is not None else json.loads(line)['id']
+
+
+def read_data(userid, game_filter: Callable = None):
+    """
+    :param game_filter: games it surely skips from their line alone aren't json decoded
+    """
+    return [json.loads(line) for line in iter_raw_data(userid, game_filter=game_filter)]
+
+
+def _since(userid):
+    _migrate_legacy_data(userid)
+    state = read_sync_state(userid) if data_exists(userid) else None
+    return None if state is None else state['createdAt'] + 1
 
 
-def get_all_games(userid, download):
+def sync_games(userid, base_url=None, session: requests.Session = None, game_filter: Callable = None) -> int:
+    """
+    downloads only the games created after the newest game already stored and appends them to the store
+    :return: number of new games
+    """
+    since = _since(userid)
+    num_new_games = append_raw_games(
+        iter_raw_games_from_lichess(userid, since=since, base_url=base_url, session=session, game_filter=game_filter),
+        userid
+    )
+    logger.info(f"synced {num_new_games} new games for {userid}")
+    return num_new_games
+
+
+@contextmanager
+def _replacing_data(userid):
+    paths = [get_path_to_user_id_games(userid), get_path_to_user_id_sync_state(userid)]
+    # keep the old data aside until the new download finished
+    for path in paths:
+        if os.path.exists(path):
+            os.replace(path, path + '.old')
+    try:
+        yield
+    except BaseException:
+        for path in paths:
+            if os.path.exists(path + '.old'):
+                os.replace(path + '.old', path)
+        raise
+    for path in paths:
+        if os.path.exists(path + '.old'):
+            os.remove(path + '.old')
+
+
+def redownload_games(userid, base_url=None, session: requests.Session = None, game_filter: Callable = None) -> int:
+    """
+    downloads the users entire history into a new store, the old one is kept until the download finished
+    :return: number of games
+    """
+    with _replacing_data(userid):
+        return append_raw_games(
+            iter_raw_games_from_lichess(userid, base_url=base_url, session=session, game_filter=game_filter), userid
+        )
+
+
+def stream_new_games(userid, download=False, base_url=None, game_filter: Callable = None) -> Iterator[dict]:
+    """
+    yields the games that weren't stored yet while they are downloaded and appended to the store
+    :param download: re-download the users entire history, otherwise only games newer than the stored ones
+    """
+    if download:
+        with _replacing_data(userid):
+            raw_games = iter_raw_games_from_lichess(userid, base_url=base_url, game_filter=game_filter)
+            for line in iter_appended_raw_games(raw_games, userid):
+                yield json.loads(line)
+        return
+    raw_games = iter_raw_games_from_lichess(userid, since=_since(userid), base_url=base_url, game_filter=game_filter)
+    for line in iter_appended_raw_games(raw_games, userid):
+        yield json.loads(line)
+
+
+def get_all_raw_games(userid, download, sync=False, game_filter: Callable = None) -> Iterator[bytes]:
+    """
+    same as get_all_games, the games are downloaded right away and their ndjson lines read lazily
+    """
     if download or not data_exists(userid):
-        games = list(get_games_from_lichess(userid))
-        save_data(games, userid)
-    elif data_exists(userid):
-        games = read_data(userid)
-    else:
-        raise ValueError("if download=False then the data must exist already")
-    return games
+        redownload_games(userid, game_filter=game_filter)
+    elif sync:
+        sync_games(userid, game_filter=game_filter)
+    return iter_raw_data(userid, game_filter=game_filter)
+
+
+def get_all_games(userid, download, sync=False, game_filter: Callable = None):
+    """
+    :param download: re-download the users entire history
+    :param sync: only download the games newer than the ones already stored
+    :param game_filter: games it skips aren't downloaded when it can tell from the query, so the store only has the
+        games of the filters used when downloading, re-download after loosening the filter
+    """
+    return [json.loads(line) for line in get_all_raw_games(userid, download, sync=sync, game_filter=game_filter)]
 
 
 if __name__ == '__main__':
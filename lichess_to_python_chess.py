@@ -1,9 +1,15 @@
-from typing import Union, List, Callable
+from typing import Union, List, Callable, Iterable
 import io
 import logging
 import time
 
 import chess.pgn
+import chess.engine
+import numpy as np
+
+from add_chess_analysis import format_score, SERVER_ANALYSIS_HEADER
+from game_record import GameRecord, pack_move
+from metrics import METRICS, log_progress
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +24,93 @@ def id_to_site(id: str) -> str:
     return LICHESS_DOT_ORG + id
 
 
+def server_eval_to_score(ply_analysis: dict) -> Union[chess.engine.Score, None]:
+    """
+    :param ply_analysis: one entry of the `analysis` array, ie: {'eval': 17} or {'mate': -3}, white's point of view
+    """
+    if 'mate' in ply_analysis:
+        return chess.engine.Mate(ply_analysis['mate'])
+    if 'eval' in ply_analysis:
+        return chess.engine.Cp(ply_analysis['eval'])
+    return None
+
+
+def add_server_analysis(game: chess.pgn.Game, game_json: dict) -> int:
+    """
+    MODIFIES "game" IN PLACE
+    adds lichess' per ply evals (`analysis`) and clocks (`clocks`, in centiseconds) to the positions missing them
+    :return: number of positions that got an eval
+    """
+    analysis = game_json.get('analysis', [])
+    clocks = game_json.get('clocks', [])
+    num_evals = 0
+    node = game
+    ply = 0
+    while len(node.variations):
+        node = node.variations[0]
+        if ply < len(analysis) and "eval" not in node.comment:
+            score = server_eval_to_score(analysis[ply])
+            if score is not None:
+                node.comment += f'[%eval {format_score(score)}]'
+                num_evals += 1
+        if ply < len(clocks) and node.clock() is None:
+            node.set_clock(clocks[ply] / 100.)
+        ply += 1
+    return num_evals
+
+
+def get_lichess_headers(game_json: dict) -> dict:
+    """
+    the headers added on top of the pgn's own headers
+    """
+    return {
+        'ID': game_json['id'],
+        'Status': game_json['status'],
+        'ClockInitial': str(game_json['clock']['initial']),
+        'ClockIncr': str(game_json['clock']['increment']),
+        'ClockTotal': str(game_json['clock']['totalTime']),
+        'Speed': game_json['speed'],
+        'Perf': game_json['perf'],
+        'opening': game_json['opening']
+    }
+
+
+def _player_name(player_json: dict) -> str:
+    if 'user' in player_json:
+        return player_json['user']['name']
+    if 'aiLevel' in player_json:
+        return f"lichess AI level {player_json['aiLevel']}"
+    return 'Anonymous'
+
+
+def get_pgn_headers(game_json: dict) -> dict:
+    """
+    the pgn headers analysis_utils and the notebook use, built from the json for when the pgn isn't parsed
+    """
+    if 'winner' in game_json:
+        result = '1-0' if game_json['winner'] == 'white' else '0-1'
+    elif game_json['status'] in ('draw', 'stalemate'):
+        result = '1/2-1/2'
+    else:
+        result = '*'
+    headers = {
+        'Site': id_to_site(game_json['id']),
+        'White': _player_name(game_json['players']['white']),
+        'Black': _player_name(game_json['players']['black']),
+        'Result': result,
+        'Variant': game_json['variant'].capitalize()
+    }
+    for color in ('white', 'black'):
+        if 'rating' in game_json['players'][color]:
+            headers[f'{color.capitalize()}Elo'] = str(game_json['players'][color]['rating'])
+    if 'opening' in game_json:
+        headers['ECO'] = game_json['opening']['eco']
+        headers['Opening'] = game_json['opening']['name']
+    if 'initialFen' in game_json:
+        headers['FEN'] = game_json['initialFen']
+    return headers
+
+
 def convert_game(game_json: dict, pgn_moves_str: Union[str, None] = None, game_filter: Callable = None) -> Union[chess.pgn.Game, None]:
     """
     :param game_json: from berserk
@@ -55,29 +148,76 @@ def convert_game(game_json: dict, pgn_moves_str: Union[str, None] = None, game_f
     :param game_filter: a filter to filter out games
     :return: chess.pgn.Game
     """
-    if game_filter(game_json):
+    if game_filter is not None and game_filter(game_json):
         logger.info(f"skipping {game_json} because filter evaluated as true")
+        METRICS.inc('games_filtered_total')
         return None
     if pgn_moves_str is None:
         pgn_moves_str = game_json['pgn']
     pgn = io.StringIO(pgn_moves_str)
     try:
-        game = chess.pgn.read_game(pgn)
+        with METRICS.timer('parse_seconds'):
+            game = chess.pgn.read_game(pgn)
     except ValueError as ve:
         logger.error(f"had an error parsing: {game_json} with {ve}")
+        METRICS.inc('games_failed_parsing_total')
         return None
-    game.headers['ID'] = game_json['id']
-    game.headers['Status'] = game_json['status']
-    game.headers['ClockInitial'] = str(game_json['clock']['initial'])
-    game.headers['ClockIncr'] = str(game_json['clock']['increment'])
-    game.headers['ClockTotal'] = str(game_json['clock']['totalTime'])
-    game.headers['Speed'] = game_json['speed']
-    game.headers['Perf'] = game_json['perf']
-    game.headers['opening'] = game_json['opening']
+    METRICS.inc('games_parsed_total')
+    game.headers.update(get_lichess_headers(game_json))
+    add_server_analysis(game, game_json)
+    if 'analysis' in game_json:
+        # the local engine only has to analyze positions lichess didn't
+        game.headers[SERVER_ANALYSIS_HEADER] = 'lichess'
     # TODO: if there is analysis, those variations should be added as well
     return game
 
 
+def convert_game_record(game_json: dict, game_filter: Callable = None,
+                        with_moves: bool = True) -> Union[GameRecord, None]:
+    """
+    fast path of convert_game that goes straight from the json's `moves`, `analysis` and `clocks` to a GameRecord
+    without parsing the pgn, use `record.to_game()` when a full chess.pgn.Game is needed
+    :param with_moves: False skips parsing the moves entirely, enough for metrics over evals and clocks
+    """
+    if game_filter is not None and game_filter(game_json):
+        logger.info(f"skipping {game_json['id']} because filter evaluated as true")
+        METRICS.inc('games_filtered_total')
+        return None
+    sans = game_json['moves'].split()
+    headers = get_pgn_headers(game_json)
+    headers.update(get_lichess_headers(game_json))
+    if 'analysis' in game_json:
+        headers[SERVER_ANALYSIS_HEADER] = 'lichess'
+    record = GameRecord.empty(headers, len(sans), with_moves=with_moves)
+    if with_moves:
+        board = record.starting_board()
+        try:
+            with METRICS.timer('parse_seconds'):
+                for i, san in enumerate(sans):
+                    move = board.push_san(san)
+                    record.moves[i] = pack_move(move)
+        except ValueError as ve:
+            logger.error(f"had an error parsing: {game_json['id']} with {ve}")
+            METRICS.inc('games_failed_parsing_total')
+            return None
+    METRICS.inc('games_parsed_total')
+    for i, ply_analysis in enumerate(game_json.get('analysis', [])[:len(sans)]):
+        record.set_eval(i + 1, server_eval_to_score(ply_analysis))
+    clocks = game_json.get('clocks', [])[:len(sans)]
+    record.clocks[1:len(clocks) + 1] = np.array(clocks, dtype=np.float32) / 100
+    return record
+
+
+def convert_game_records(game_jsons: Iterable[dict], game_filter: Callable = None,
+                         with_moves: bool = True) -> List[GameRecord]:
+    records = []
+    for game_json in game_jsons:
+        record = convert_game_record(game_json, game_filter=game_filter, with_moves=with_moves)
+        if record is not None:
+            records.append(record)
+    return records
+
+
 def convert_games(game_jsons: List[dict], game_filter: Callable = None) -> List[chess.pgn.Game]:
     games = []
     start = time.time()
@@ -85,9 +225,5 @@ def convert_games(game_jsons: List[dict], game_filter: Callable = None) -> List[
         game = convert_game(game_json, game_filter=game_filter)
         if game is not None:
             games.append(game)
-        if i % 10 == 0 and i != 0:
-            total_elapses_so_far = time.time() - start
-            expected_time = total_elapses_so_far * (len(game_jsons) / (i + 1))
-            logger.info(f"done converting {i} games out of {len(game_jsons)} ({i / len(game_jsons)}%), "
-                        f"should take expected {expected_time / 60} minutes")
+        log_progress('convert', i + 1, len(game_jsons), start)
     return games
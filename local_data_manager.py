@@ -1,148 +1,499 @@
 import os
 import pickle
+import hashlib
+import json
 import logging
 import io
-from typing import Callable
+import time
+from typing import Callable, Iterable, Iterator, List
 
-import chess.engine
 import chess.pgn
 
 import lichess_data_manager
 import lichess_to_python_chess
 import add_chess_analysis
+import pipeline
+from eval_cache import EvalCache
+from game_store import DATA_FOLDER, GameStore, get_game_id, get_path_to_user_id_games
+from game_record import GameRecord, read_record
+from metrics import profile_stage
+from work_queue import WorkQueue, get_analysis_job
 
-DATA_FOLDER = 'data'
 logger = logging.getLogger(__name__)
 
 
-def get_games_from_lichess(userid, download):
-    return lichess_data_manager.get_all_games(userid, download)
+def get_games_from_lichess(userid, download, sync=False, game_filter: Callable = None):
+    return lichess_data_manager.get_all_games(userid, download, sync=sync, game_filter=game_filter)
 
 
-def get_path_to_user_id_games(userid, analysis_time):
-    analysis_prefix = "no" if analysis_time is None else str(analysis_time)
-    return os.path.join(DATA_FOLDER, f'{userid}.python_chess.{analysis_prefix}_analysis.pickle')
+def get_path_to_legacy_user_id_games(userid, analysis_time):
+    return get_path_to_user_id_games(userid, analysis_time) + '.pickle'
 
 
 def data_exists(userid, analysis_time):
-    return os.path.exists(get_path_to_user_id_games(userid, analysis_time))
+    return GameStore.exists(get_path_to_user_id_games(userid, analysis_time)) or \
+        os.path.exists(get_path_to_legacy_user_id_games(userid, analysis_time))
 
 
-def save_data(games, userid, analysis_time):
-    path = get_path_to_user_id_games(userid, analysis_time)
-    games = list(games)
-    os.makedirs(DATA_FOLDER, exist_ok=True)
-    with open(path, 'wb') as f:
-        for game in games:
-            pickle.dump(str(game), f)
-
-
-def read_data(userid, analysis_time):
-    path = get_path_to_user_id_games(userid, analysis_time)
+def _read_legacy_data(path):
     with open(path, 'rb') as f:
-        games = []
         while True:
             try:
                 loaded = pickle.load(f)
-                pgn = io.StringIO(loaded)
-                game = chess.pgn.read_game(pgn)
-                games.append(game)
             except EOFError:
                 break
-        return games
-
-
-def combine_berserk_and_analysis_data(userid, download, analysis_time):
-    def get_new_games_data(games_data, games_lichess_dict):
-        new_games = []
-        for game in games_data:
-            id = lichess_to_python_chess.site_to_id(game.headers['Site'])
-            game_json = games_lichess_dict[id]
-            new_games.append(
-                lichess_to_python_chess.convert_game(
-                    game_json,
-                    pgn_moves_str=str(game)
-                )
-            )
-        return new_games
-    games_lichess = get_games_from_lichess(userid, download)
-    games_lichess_dict = {}
-    for game_json in games_lichess:
-        games_lichess_dict[game_json['id']] = game_json
-
-    games_data_without_analysis = read_data(userid, None)
-    new_games_without_analysis = get_new_games_data(games_data_without_analysis, games_lichess_dict)
-    save_data(new_games_without_analysis, userid, None)
+            yield chess.pgn.read_game(io.StringIO(loaded))
+
+
+def open_data(userid, analysis_time) -> GameStore:
+    """
+    the saved games with only their index loaded, games are parsed when accessed
+    ie: `open_data(userid, 0.25)['bB1gKq4J']` or `open_data(userid, 0.25).select(lambda h: h['Speed'] == 'blitz')`
+    """
+    path = get_path_to_user_id_games(userid, analysis_time)
+    store = GameStore(path)
+    legacy_path = get_path_to_legacy_user_id_games(userid, analysis_time)
+    if not GameStore.exists(path) and os.path.exists(legacy_path):
+        logger.info(f"migrating {legacy_path} to an indexed game store")
+        store.rewrite(_read_legacy_data(legacy_path))
+    return store
+
+
+def save_data(games, userid, analysis_time):
+    os.makedirs(DATA_FOLDER, exist_ok=True)
+    GameStore(get_path_to_user_id_games(userid, analysis_time)).rewrite(games)
+
+
+def append_data(games, userid, analysis_time):
+    os.makedirs(DATA_FOLDER, exist_ok=True)
+    open_data(userid, analysis_time).extend(games)
+
+
+def read_data(userid, analysis_time):
+    return list(open_data(userid, analysis_time))
 
+
+def read_records(userid, analysis_time, with_moves: bool = True) -> List[GameRecord]:
+    """
+    the saved games as compact GameRecords, for metrics over the whole corpus, read without building any game tree
+    :param with_moves: False doesn't parse the moves, which is most of the reading time, when only evals are needed
+    """
+    store = open_data(userid, analysis_time)
+    return [read_record(store.read_pgn(game_id), with_moves=with_moves) for game_id in store.ids()]
+
+
+def _source_hash(line: bytes) -> str:
+    return hashlib.blake2b(line.rstrip(b'\n'), digest_size=16).hexdigest()
+
+
+def _merge_lichess_data(store: GameStore, raw_games: Iterable[bytes], hash_key: str,
+                        merge: Callable[[dict, str], chess.pgn.Game], max_garbage_ratio: float = 0.5) -> int:
+    """
+    replaces the stored games whose lichess data changed since they were last merged with `merge(game_json, pgn)`
+    the hash of each game's ndjson line is kept in its index entry under hash_key, so unchanged games are skipped
+    without json decoding them or parsing their pgn, and only the merged games are appended to the store
+    :return: number of merged games
+    """
+    merged_hashes = {store.entry(game_id).get(hash_key) for game_id in store.ids()}
+    num_merged = 0
+    for line in raw_games:
+        source_hash = _source_hash(line)
+        if source_hash in merged_hashes:
+            continue
+        game_json = json.loads(line)
+        if game_json['id'] not in store:
+            # only the games already saved are merged, new games go through get_all_games
+            continue
+        game = merge(game_json, store.read_pgn(game_json['id']))
+        if game is None:
+            logger.warning(f"failed merging {game_json['id']}, kept it as it was")
+            continue
+        store.replace(game, **{hash_key: source_hash})
+        num_merged += 1
+    store.flush()
+    store.compact_if_needed(max_garbage_ratio)
+    logger.info(f"merged the lichess data of {num_merged} games into {store.path}, {len(store)} games in total")
+    return num_merged
+
+
+def _merge_berserk(game_json: dict, pgn: str) -> chess.pgn.Game:
+    return lichess_to_python_chess.convert_game(game_json, pgn_moves_str=pgn)
+
+
+def get_path_to_user_id_plies(userid, analysis_time):
+    return get_path_to_user_id_games(userid, analysis_time) + '.plies'
+
+
+def export_plies(userid, analysis_time) -> int:
+    """
+    exports the saved games to a parquet dataset with one row per ply, see read_plies
+    only the games saved or changed since the last export are written
+    :return: number of games exported
+    """
+    # pyarrow and pandas are only imported by the commands that need them, see main.py
+    from ply_table import PlyDataset
+    with profile_stage('export'):
+        return PlyDataset(get_path_to_user_id_plies(userid, analysis_time)).update(open_data(userid, analysis_time))
+
+
+def read_plies(userid, analysis_time, columns: List[str] = None, filters=None):
+    """
+    the exported plies as a DataFrame, memory mapped and with the filters pushed down to the parquet files
+    ie: `read_plies(userid, 0.25, columns=['id', 'ply', 'eval'], filters=[('Speed', '=', 'blitz')])`
+    see ply_table.PLY_SCHEMA for the columns
+    """
+    from ply_table import PlyDataset
+    return PlyDataset(get_path_to_user_id_plies(userid, analysis_time)).read(columns=columns, filters=filters)
+
+
+def combine_berserk_and_analysis_data(userid, download, analysis_time) -> GameStore:
+    """
+    refreshes the lichess headers of the saved games, only the games whose lichess data changed are touched
+    :return: the store with analysis_time, or without analysis when analysis_time is None
+    """
+    os.makedirs(DATA_FOLDER, exist_ok=True)
+    store = open_data(userid, None)
+    _merge_lichess_data(store, lichess_data_manager.get_all_raw_games(userid, download), 'berserk_hash',
+                        _merge_berserk)
     if analysis_time is not None:
-        games_data_with_analysis = read_data(userid, analysis_time)
-        new_games_with_analysis = get_new_games_data(games_data_with_analysis, games_lichess_dict)
-        save_data(new_games_with_analysis, userid, analysis_time)
-        return new_games_with_analysis
-    return new_games_without_analysis
-
-
-def combine_lichess_analysis_and_analysis_data(userid, download, analysis_time):
-    def get_new_games_data(games_data, games_lichess_dict):
-        new_games = []
-        for game in games_data:
-            id = lichess_to_python_chess.site_to_id(game.headers['Site'])
-            game_json = games_lichess_dict[id]
-            converted_game = lichess_to_python_chess.convert_game(
-                game_json,
-                pgn_moves_str=game_json['pgn']
-            )
-            if 'analysis' not in game_json:
-                # got to combine clock here
-                converted_game_with_self_analysis = lichess_to_python_chess.convert_game(
-                    game_json,
-                    pgn_moves_str=str(game)
-                )
-                cur_move = converted_game
-                cur_move_with_self_analysis = converted_game_with_self_analysis
-                i = 0
-                while len(cur_move.variations) and len(cur_move_with_self_analysis.variations):
-                    if i != 0:
-                        # skip the first eval before any move played
-                        cur_move.comment = cur_move_with_self_analysis.comment + " " + cur_move.comment
-                    cur_move = cur_move.variations[0]
-                    cur_move_with_self_analysis = cur_move_with_self_analysis.variations[0]
-                    i += 1
-            new_games.append(
-                converted_game
-            )
-        return new_games
-    games_lichess = get_games_from_lichess(userid, download)
-    games_lichess_dict = {}
-    for game_json in games_lichess:
-        games_lichess_dict[game_json['id']] = game_json
-
-    games_data_with_analysis = read_data(userid, analysis_time)
-    new_games_with_analysis = get_new_games_data(games_data_with_analysis, games_lichess_dict)
-    save_data(new_games_with_analysis, userid, analysis_time)
-    return new_games_with_analysis
-
-
-def get_all_games(userid, engine, download, parse, analysis_time, game_filter: Callable= None):
-    if parse:
-        # from `brew install stockfish`
-        games = get_games_from_lichess(userid, download)
-        games = lichess_to_python_chess.convert_games(games, game_filter=game_filter)
-        save_data(games, userid, None)
-        games = add_chess_analysis.add_eval_to_games(games, engine, analysis_time=analysis_time)
+        store = open_data(userid, analysis_time)
+        _merge_lichess_data(store, lichess_data_manager.get_all_raw_games(userid, download=False), 'berserk_hash',
+                            _merge_berserk)
+    return store
+
+
+def _merge_lichess_analysis(game_json: dict, pgn: str) -> chess.pgn.Game:
+    converted_game = lichess_to_python_chess.convert_game(
+        game_json,
+        pgn_moves_str=game_json['pgn']
+    )
+    if 'analysis' not in game_json:
+        # got to combine clock here
+        converted_game_with_self_analysis = lichess_to_python_chess.convert_game(
+            game_json,
+            pgn_moves_str=pgn
+        )
+        cur_move = converted_game
+        cur_move_with_self_analysis = converted_game_with_self_analysis
+        i = 0
+        while len(cur_move.variations) and len(cur_move_with_self_analysis.variations):
+            if i != 0:
+                # skip the first eval before any move played
+                cur_move.comment = cur_move_with_self_analysis.comment + " " + cur_move.comment
+            cur_move = cur_move.variations[0]
+            cur_move_with_self_analysis = cur_move_with_self_analysis.variations[0]
+            i += 1
+    # lichess' pgn doesn't have the headers added here, ie: AnalysisTime that tells which games are analyzed
+    for name, value in chess.pgn.read_headers(io.StringIO(pgn)).items():
+        if name not in converted_game.headers:
+            converted_game.headers[name] = value
+    return converted_game
+
+
+def combine_lichess_analysis_and_analysis_data(userid, download, analysis_time) -> GameStore:
+    """
+    replaces the saved games with lichess' own pgn, keeping our evals for the games lichess didn't analyze
+    only the games whose lichess data changed since they were last combined are touched
+    """
+    os.makedirs(DATA_FOLDER, exist_ok=True)
+    store = open_data(userid, analysis_time)
+    _merge_lichess_data(store, lichess_data_manager.get_all_raw_games(userid, download), 'lichess_analysis_hash',
+                        _merge_lichess_analysis)
+    return store
+
+
+def get_path_to_user_id_checkpoint(userid, analysis_time):
+    return get_path_to_user_id_games(userid, analysis_time) + '.checkpoint'
+
+
+class _Checkpointer:
+    """
+    appends analyzed games to the checkpoint store and makes them durable every `every_games` games
+    or `every_seconds` seconds, whichever comes first
+    """
+    def __init__(self, store: GameStore, every_games: int, every_seconds: float):
+        self.store = store
+        self.every_games = every_games
+        self.every_seconds = every_seconds
+        self._since_flush = 0
+        self._last_flush = time.time()
+
+    def __call__(self, i, game):
+        self.store.append(game)
+        self._since_flush += 1
+        if self._since_flush >= self.every_games or time.time() - self._last_flush >= self.every_seconds:
+            self.flush()
+
+    def flush(self):
+        if self._since_flush:
+            self.store.flush()
+            logger.info(f"checkpointed {self._since_flush} analyzed games, {len(self.store)} in total")
+        self._since_flush = 0
+        self._last_flush = time.time()
+
+
+def analyze_games(games, engine, analysis_time, workers: int = 1, engine_path: str = None,
+                  engine_options: dict = None, eval_cache: EvalCache = None, on_game_analyzed: Callable = None,
+                  adaptive: add_chess_analysis.AdaptiveAnalysis = None,
+                  schedule: add_chess_analysis.GameOrderedSchedule = None):
+    if workers > 1:
+        if engine_path is None:
+            raise ValueError("engine_path is needed to start more than one engine")
+        return add_chess_analysis.add_eval_to_games_parallel(
+            games, engine_path, analysis_time=analysis_time, workers=workers, engine_options=engine_options,
+            cache=eval_cache, on_game_analyzed=on_game_analyzed, adaptive=adaptive, schedule=schedule
+        )
+    if engine_options:
+        engine.configure(engine_options)
+    return add_chess_analysis.add_eval_to_games(games, engine, analysis_time=analysis_time, cache=eval_cache,
+                                                on_game_analyzed=on_game_analyzed, adaptive=adaptive,
+                                                schedule=schedule)
+
+
+def analyze_and_save_games(games, userid, engine, analysis_time, checkpoint_every_games: int = 10,
+                           checkpoint_every_seconds: float = 300, **analysis_kwargs):
+    """
+    analyzes "games" and saves them, every finished game is checkpointed so a run that crashed or was stopped
+    resumes where it stopped, games already analyzed with analysis_time in the checkpoint are not analyzed again
+    :param analysis_kwargs: passed to analyze_games
+    """
+    checkpoint = GameStore(get_path_to_user_id_checkpoint(userid, analysis_time))
+    adaptive = analysis_kwargs.get('adaptive') is not None
+    games = list(games)
+    pending_indices = []
+    for i, game in enumerate(games):
+        game_id = get_game_id(game)
+        if game_id in checkpoint and add_chess_analysis.is_analysis_header_done(
+                checkpoint.headers(game_id).get(add_chess_analysis.ANALYSIS_TIME_HEADER), analysis_time, adaptive):
+            games[i] = checkpoint.get(game_id)
+        elif not add_chess_analysis.is_game_analyzed(game, analysis_time, adaptive):
+            pending_indices.append(i)
+    if len(pending_indices) != len(games):
+        logger.info(f"resuming analysis, {len(games) - len(pending_indices)} games out of {len(games)} "
+                    f"are already analyzed")
+    pending_games = [games[i] for i in pending_indices]
+    checkpointer = _Checkpointer(checkpoint, checkpoint_every_games, checkpoint_every_seconds)
+    try:
+        with profile_stage('analysis'):
+            pending_games = analyze_games(pending_games, engine, analysis_time, on_game_analyzed=checkpointer,
+                                          **analysis_kwargs)
+    finally:
+        checkpointer.flush()
+    for i, game in zip(pending_indices, pending_games):
+        games[i] = game
+    with profile_stage('save'):
         save_data(games, userid, analysis_time)
-        logger.info("saved data")
-        return games
+    checkpoint.clear()
+    logger.info("saved data")
+    return games
+
+
+def analyze_saved_games(userid, engine, analysis_time, **analysis_kwargs) -> int:
+    """
+    analyzes only the parsed games that aren't analyzed with analysis_time yet, each one is appended to the
+    analyzed games as soon as it is done, so a stopped run resumes where it stopped
+    :param engine: only used when there is something to analyze, see add_chess_analysis.LazyEngine
+    :param analysis_kwargs: passed to analyze_games
+    :return: number of games analyzed
+    """
+    os.makedirs(DATA_FOLDER, exist_ok=True)
+    parsed_store = open_data(userid, None)
+    analyzed_store = open_data(userid, analysis_time)
+    analysis_header = add_chess_analysis.ANALYSIS_TIME_HEADER
+    adaptive = analysis_kwargs.get('adaptive') is not None
+    pending_games = [
+        parsed_store.get(game_id) for game_id in parsed_store.ids()
+        if game_id not in analyzed_store or not add_chess_analysis.is_analysis_header_done(
+            analyzed_store.headers(game_id).get(analysis_header), analysis_time, adaptive)
+    ]
+    logger.info(f"{len(pending_games)} games to analyze, {len(parsed_store) - len(pending_games)} already are")
+    if not pending_games:
+        return 0
+    try:
+        with profile_stage('analysis'):
+            analyze_games(pending_games, engine, analysis_time,
+                          on_game_analyzed=lambda i, game: analyzed_store.append(game), **analysis_kwargs)
+    finally:
+        analyzed_store.flush()
+    return len(pending_games)
+
+
+def enqueue_analysis(userid, analysis_time, queue_path: str = None) -> str:
+    """
+    puts every parsed game that isn't analyzed with analysis_time yet in the shared work queue, for workers on
+    any machine to analyze with `python work_queue.py <job> --engine ... --analysis-time ...`
+    :return: the job to give the workers
+    """
+    job = get_analysis_job(userid, analysis_time)
+    parsed_store = open_data(userid, None)
+    analyzed_store = open_data(userid, analysis_time)
+    analysis_header = add_chess_analysis.ANALYSIS_TIME_HEADER
+
+    def tasks():
+        for game_id in parsed_store.ids():
+            if game_id in analyzed_store and add_chess_analysis.is_analysis_header_done(
+                    analyzed_store.headers(game_id).get(analysis_header), analysis_time):
+                continue
+            yield game_id, parsed_store.read_pgn(game_id)
+    with WorkQueue(queue_path) as work_queue:
+        num_new = work_queue.enqueue(job, tasks())
+        logger.info(f"enqueued {num_new} games to analyze for {job}, {work_queue.counts(job)}")
+    return job
+
+
+def merge_analysis(userid, analysis_time, queue_path: str = None, allow_unfinished: bool = False) -> GameStore:
+    """
+    the final step of a distributed analysis, writes the analyzed store from the parsed games and the workers results
+    games the workers didn't analyze are kept as they were, so nothing is lost when some failed
+    :param allow_unfinished: merge what is done even while workers still have games to analyze
+    """
+    job = get_analysis_job(userid, analysis_time)
+    with WorkQueue(queue_path) as work_queue:
+        if not allow_unfinished and not work_queue.is_finished(job):
+            raise ValueError(f"{job} isn't finished yet: {work_queue.counts(job)}")
+        results = dict(work_queue.results(job))
+        for game_id, error in work_queue.failures(job):
+            logger.error(f"{game_id} failed analysis: {error}")
+    parsed_store = open_data(userid, None)
+    analyzed_store = open_data(userid, analysis_time)
+
+    def merged_games():
+        for game_id in parsed_store.ids():
+            if game_id in results:
+                yield chess.pgn.read_game(io.StringIO(results[game_id]))
+            elif game_id in analyzed_store:
+                yield analyzed_store.get(game_id)
+            else:
+                yield parsed_store.get(game_id)
+    os.makedirs(DATA_FOLDER, exist_ok=True)
+    analyzed_store.rewrite(merged_games())
+    logger.info(f"merged {len(results)} analyzed games into {analyzed_store.path}")
+    return analyzed_store
+
+
+def get_all_games(userid, engine, download, parse, analysis_time, game_filter: Callable= None,
+                  workers: int = 1, engine_path: str = None, engine_options: dict = None,
+                  eval_cache: EvalCache = None, sync: bool = False, checkpoint_every_games: int = 10,
+                  checkpoint_every_seconds: float = 300, adaptive: add_chess_analysis.AdaptiveAnalysis = None,
+                  schedule: add_chess_analysis.GameOrderedSchedule = None):
+    """
+    :param sync: download only the games newer than the ones already downloaded before parsing
+    :param workers: number of engine processes to analyze with, more than 1 needs engine_path
+    :param engine_path: path to the uci engine binary, used to start the workers
+    :param engine_options: uci options for every engine, ie: {"Threads": 1, "Hash": 256}
+    :param eval_cache: positions already analyzed with the same limit are read from here instead of the engine
+    :param checkpoint_every_games: analyzed games are saved at least this often, so a crashed run can resume
+    :param checkpoint_every_seconds: and at least this often
+    :param adaptive: quick first pass on every position and analysis_time only where it matters
+    :param schedule: analyse each game from its last position back on a warm engine hash
+    """
+    analysis_kwargs = dict(
+        workers=workers, engine_path=engine_path, engine_options=engine_options, eval_cache=eval_cache,
+        adaptive=adaptive, schedule=schedule
+    )
+    checkpoint_kwargs = dict(
+        checkpoint_every_games=checkpoint_every_games, checkpoint_every_seconds=checkpoint_every_seconds
+    )
+    if parse:
+        with profile_stage('download'):
+            games = get_games_from_lichess(userid, download, sync=sync, game_filter=game_filter)
+        with profile_stage('convert'):
+            games = lichess_to_python_chess.convert_games(games, game_filter=game_filter)
+        with profile_stage('save'):
+            save_data(games, userid, None)
+        if analysis_time is None:
+            return games
+        return analyze_and_save_games(games, userid, engine, analysis_time, **checkpoint_kwargs, **analysis_kwargs)
     elif analysis_time is not None:
         if data_exists(userid, analysis_time):
-            return read_data(userid, analysis_time)
-        games = read_data(userid, None)
-        games = add_chess_analysis.add_eval_to_games(games, engine, analysis_time=analysis_time)
-        save_data(games, userid, analysis_time)
-        logger.info("saved data")
-        return games
+            # `main.py analyze` saves each game once it is analyzed, a run it stopped in the middle of is finished first
+            analyze_saved_games(userid, engine, analysis_time, **analysis_kwargs)
+            with profile_stage('load'):
+                return read_data(userid, analysis_time)
+        with profile_stage('load'):
+            games = read_data(userid, None)
+        return analyze_and_save_games(games, userid, engine, analysis_time, **checkpoint_kwargs, **analysis_kwargs)
     raise ValueError("either parse or analysis time")
 
 
+def stream_all_games(userid, engine, download, analysis_time, game_filter: Callable = None,
+                     eval_cache: EvalCache = None, queue_size: int = 8,
+                     adaptive: add_chess_analysis.AdaptiveAnalysis = None,
+                     schedule: add_chess_analysis.GameOrderedSchedule = None) -> int:
+    """
+    streams the games not downloaded yet through download -> filter/convert -> analyze -> append to disk,
+    every game is saved as soon as it is done so memory doesn't grow with the users history
+    :param download: re-download the users entire history and rewrite the saved games once it all went through,
+        otherwise only the new games are downloaded and appended
+    :return: number of games saved
+    """
+    os.makedirs(DATA_FOLDER, exist_ok=True)
+    stores = []
+    parsed_store = _open_streamed_store(userid, None, download, stores)
+    analyzed_store = _open_streamed_store(userid, analysis_time, download, stores) if analysis_time is not None \
+        else None
+    # games an earlier stream downloaded but died before saving, the raw store already counts them as synced
+    pending_games = () if download else \
+        _iter_unsaved_raw_games(userid, analyzed_store if analyzed_store is not None else parsed_store, game_filter)
+    stages = []
+
+    def convert(game_json):
+        game = lichess_to_python_chess.convert_game(game_json, game_filter=game_filter)
+        if game is not None:
+            parsed_store.append(game)
+        return game
+    stages.append(convert)
+
+    def save(game):
+        pass
+    if analysis_time is not None:
+        def analyze(game):
+            return add_chess_analysis.add_eval_to_game(game, engine, analysis_time=analysis_time, cache=eval_cache,
+                                                       adaptive=adaptive, schedule=schedule)
+        stages.append(analyze)
+
+        def save(game):
+            analyzed_store.append(game)
+
+    def source():
+        # a generator, so closing it when the pipeline stops also closes the download and restores the raw store
+        yield from pending_games
+        yield from lichess_data_manager.stream_new_games(userid, download=download, game_filter=game_filter)
+
+    num_games = pipeline.run_pipeline(source(), stages, save, queue_size=queue_size)
+    for store, new_store in stores:
+        new_store.flush()
+        store.replace_with(new_store)
+    logger.info(f"streamed and saved {num_games} new games for {userid}")
+    return num_games
+
+
+def _open_streamed_store(userid, analysis_time, download, stores: list) -> GameStore:
+    # a re-download streams into a store aside, swapped in only once the whole history went through
+    store = open_data(userid, analysis_time)
+    if not download:
+        return store
+    new_store = store.new_store_aside()
+    stores.append((store, new_store))
+    return new_store
+
+
+def _iter_unsaved_raw_games(userid, saved_store: GameStore, game_filter: Callable = None) -> Iterator[dict]:
+    # only the lines of games that aren't saved are decoded
+    if not lichess_data_manager.data_exists(userid):
+        return
+    num_games = 0
+    for line in lichess_data_manager.iter_raw_data(userid, game_filter=game_filter):
+        if lichess_data_manager.raw_game_id(line) in saved_store:
+            continue
+        game_json = json.loads(line)
+        if game_filter is not None and game_filter(game_json):
+            continue
+        num_games += 1
+        yield game_json
+    if num_games:
+        logger.info(f"resumed {num_games} games downloaded but not saved by an earlier stream")
+
+
 if __name__ == '__main__':
     _ = combine_lichess_analysis_and_analysis_data('chessprimes', download=False, analysis_time=0.25)
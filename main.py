@@ -1,41 +1,220 @@
-import local_data_manager
+"""
+ie: `python main.py sync chessprimes`, `python main.py analyze chessprimes --analysis-time 0.25`,
+`python main.py stats chessprimes`, `python main.py --help` for everything else
+the heavy modules (chess.engine, requests, pandas, pyarrow) are only imported by the subcommands that use them,
+so cron jobs running sync or stats start quickly
+"""
+from typing import List
+import argparse
+import logging
+import os
+import time
+
 from logging_config import init_logger
 from filter import (
-    AND, filter_if_not_rated_game, filter_if_anonymous_player,
+    OR, filter_if_not_rated_game, filter_if_anonymous_player,
     filter_if_played_against_ai, filter_if_variant_is_not_in
 )
+from metrics import METRICS, enable_profiling
 
-import chess.engine
+logger = logging.getLogger(__name__)
 
+# from `brew install stockfish`
+# a list of paths analyses every position on all of them concurrently and averages their scores
+ENGINE_PATH = os.environ.get("ENGINE_PATH", "/usr/local/Cellar/stockfish/12/bin/stockfish")
+EVAL_CACHE_MAX_POSITIONS = 1_000_000  # shared opening positions are only analyzed once across games and runs
 
-def get_engine():
-    return chess.engine.SimpleEngine.popen_uci("/usr/local/Cellar/stockfish/12/bin/stockfish")
 
+def get_game_filter():
+    # skips a game if any of these filters match
+    return OR(
+        filter_if_not_rated_game(),
+        filter_if_anonymous_player(),
+        filter_if_played_against_ai(),
+        filter_if_variant_is_not_in('standard')
+    )
 
-if __name__ == '__main__':
+
+def parse_engine_options(options: List[str]) -> dict:
+    engine_options = {}
+    for option in options:
+        name, _, value = option.partition('=')
+        engine_options[name] = int(value) if value.lstrip('-').isdigit() else value
+    return engine_options
+
+
+def add_engine_arguments(parser: argparse.ArgumentParser):
+    """
+    the engine settings of the analyze command, shared with the work queue workers, see get_engine_settings
+    """
+    parser.add_argument('--engine', nargs='+', default=[ENGINE_PATH],
+                        help="uci engine path, several paths average their scores, defaults to $ENGINE_PATH")
+    parser.add_argument('--option', action='append', default=[],
+                        help="uci option for each engine, ie: --option Hash=256 --option Threads=1")
+    parser.add_argument('--eval-cache-size', type=int, default=EVAL_CACHE_MAX_POSITIONS,
+                        help="positions kept in the eval cache, 0 turns it off")
+    parser.add_argument('--reverse', action='store_true',
+                        help="last position first on a warm hash, pair it with a large --option Hash")
+
+
+def get_engine_settings(args) -> tuple:
+    """
+    :return: engine path (a list for an ensemble), engine options, eval cache (None when turned off) and schedule,
+        the eval cache has to be closed
+    """
+    from add_chess_analysis import GameOrderedSchedule
+    from eval_cache import EvalCache
+    engine_path = args.engine[0] if len(args.engine) == 1 else args.engine
+    engine_options = parse_engine_options(args.option)
+    eval_cache = EvalCache(max_entries=args.eval_cache_size) if args.eval_cache_size else None
+    schedule = GameOrderedSchedule() if args.reverse else None
+    return engine_path, engine_options, eval_cache, schedule
+
+
+def sync(args):
+    import lichess_data_manager
+    start = time.time()
+    game_filter = None if args.no_filter else get_game_filter()
+    # downloads right away, the stored games are only read if iterated
+    lichess_data_manager.get_all_raw_games(args.userid, args.download, sync=True, game_filter=game_filter)
+    logger.info(f"downloaded {METRICS.counter('games_downloaded_total'):.0f} games for {args.userid} "
+                f"in {time.time() - start:.1f} seconds")
+
+
+def convert(args):
+    import local_data_manager
+    local_data_manager.get_all_games(
+        userid=args.userid, engine=None, download=False, sync=args.sync, parse=True, analysis_time=None,
+        game_filter=None if args.no_filter else get_game_filter()
+    )
+
+
+def analyze(args):
+    import local_data_manager
+    from add_chess_analysis import AdaptiveAnalysis, LazyEngine
+    engine_path, engine_options, eval_cache, schedule = get_engine_settings(args)
+    adaptive = AdaptiveAnalysis(rating_bands=(175,), game_budget=args.game_budget) if args.adaptive else None
+    # the engine is only started once a position needs it, the workers start their own
+    with LazyEngine(engine_path, engine_options) as engine:
+        try:
+            if args.stream:
+                local_data_manager.stream_all_games(
+                    userid=args.userid, engine=engine, download=False, analysis_time=args.analysis_time,
+                    eval_cache=eval_cache, adaptive=adaptive, schedule=schedule,
+                    game_filter=None if args.no_filter else get_game_filter()
+                )
+            else:
+                local_data_manager.analyze_saved_games(
+                    args.userid, engine, args.analysis_time, workers=args.workers, engine_path=engine_path,
+                    engine_options=engine_options if args.workers > 1 else None, eval_cache=eval_cache,
+                    adaptive=adaptive, schedule=schedule
+                )
+        finally:
+            if eval_cache is not None:
+                eval_cache.close()
+    if not args.no_export:
+        # only the games analyzed since the last export are written
+        local_data_manager.export_plies(args.userid, args.analysis_time)
+
+
+def export(args):
+    import local_data_manager
+    local_data_manager.export_plies(args.userid, args.analysis_time)
+
+
+def stats(args):
+    # only reads the stores' indexes, no game is parsed
+    from game_store import GameStore, get_path_to_user_id_games
+    store = GameStore(get_path_to_user_id_games(args.userid, args.analysis_time))
+    headers = [store.headers(game_id) for game_id in store.ids()]
+    print(f"{len(headers)} games saved for {args.userid} ({store.path})")
+    if not headers:
+        return
+    if args.analysis_time is not None:
+        analyzed = sum(h.get('AnalysisTime') == str(args.analysis_time) for h in headers)
+        print(f"analyzed with {args.analysis_time}s: {analyzed}")
+        # see add_chess_analysis.ADAPTIVE_ANALYSIS_PREFIX, not imported to keep stats quick
+        adaptive = sum(h.get('AnalysisTime') == f'adaptive:{args.analysis_time}' for h in headers)
+        if adaptive:
+            print(f"analyzed with --adaptive: {adaptive}")
+    print(f"with lichess analysis: {sum('ServerAnalysis' in h for h in headers)}")
+    dates = sorted(h['UTCDate'] for h in headers if 'UTCDate' in h)
+    if dates:
+        print(f"played from {dates[0]} to {dates[-1]}")
+    by_speed = {}
+    for h in headers:
+        by_speed[h.get('Speed', '?')] = by_speed.get(h.get('Speed', '?'), 0) + 1
+    print("by speed: " + ", ".join(f"{speed} {count}" for speed, count in sorted(by_speed.items())))
+    userid = args.userid.lower()
+    wins = draws = losses = 0
+    for h in headers:
+        playing_white = h.get('White', '').lower() == userid
+        if h.get('Result') == '1/2-1/2':
+            draws += 1
+        elif h.get('Result') in ('1-0', '0-1'):
+            if (h['Result'] == '1-0') == playing_white:
+                wins += 1
+            else:
+                losses += 1
+    print(f"wins {wins}, draws {draws}, losses {losses}")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="downloads, parses, analyzes and exports a lichess user's games")
+    parser.add_argument('--metrics-path', default='logs/metrics.jsonl',
+                        help="per stage counters and histograms, appended at the end of every run")
+    parser.add_argument('--prometheus-path', default=None, help="ie: a node exporter textfile collector path")
+    parser.add_argument('--profile', action='store_true', help="dumps a cProfile of every stage to logs/profiles")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_command(name, func, help, analysis_time_required=False):
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.add_argument('userid')
+        if analysis_time_required is not None:
+            subparser.add_argument('--analysis-time', type=float, required=analysis_time_required,
+                                   help="in seconds per position, leave out for the games without analysis")
+        subparser.set_defaults(func=func)
+        return subparser
+
+    sync_parser = add_command('sync', sync, "downloads the games played since the last sync",
+                              analysis_time_required=None)
+    sync_parser.add_argument('--download', action='store_true', help="re-downloads the entire history instead")
+    sync_parser.add_argument('--no-filter', action='store_true', help="keeps unrated, anonymous, ai, variant games")
+
+    convert_parser = add_command('convert', convert, "parses the downloaded games", analysis_time_required=None)
+    convert_parser.add_argument('--sync', action='store_true', help="syncs with lichess first")
+    convert_parser.add_argument('--no-filter', action='store_true')
+
+    analyze_parser = add_command('analyze', analyze, "analyzes the parsed games not analyzed yet",
+                                 analysis_time_required=True)
+    add_engine_arguments(analyze_parser)
+    analyze_parser.add_argument('--workers', type=int, default=1, help="number of engine processes")
+    analyze_parser.add_argument('--adaptive', action='store_true',
+                                help="quick pass on every position, analysis time only where it matters")
+    analyze_parser.add_argument('--game-budget', type=float, default=10,
+                                help="seconds of deep analysis per game with --adaptive")
+    analyze_parser.add_argument('--stream', action='store_true',
+                                help="downloads, parses and analyzes only the new games one by one instead")
+    analyze_parser.add_argument('--no-filter', action='store_true')
+    analyze_parser.add_argument('--no-export', action='store_true',
+                                help="doesn't update the parquet plies afterwards, see the export command")
+
+    add_command('export', export, "exports one parquet row per ply, see local_data_manager.read_plies")
+    add_command('stats', stats, "counts of the saved games, from the index only")
+    return parser
+
+
+def main(argv: List[str] = None):
+    args = get_parser().parse_args(argv)
     init_logger()
-    USER_ID = 'chessprimes'
-    # TODO: add partial downloading to update new games
-    SHOULD_DOWNLOAD_FROM_LICHESS = False  # true if you haven't downloaded yet or want to redownload
-    # TODO: add partial parsing to update new games
-    SHOULD_PARSE_DOWNLOADED_GAMES = True  # true if you haven't parsed yet or want to parse
-    # TODO: add partial analysis to update new games, or update specific positions
-    # TODO: add multi-engine support for averaging multiple engines
-    # TODO: add quick and long analysis if not converging for speed up for simple positions (ie: mate in 5)
-    ENGINE_ANALYSIS_TIME = None  # 0.25  # in seconds
-    with get_engine() as engine:  # to automatically close
-        games = local_data_manager.get_all_games(
-            userid=USER_ID,
-            engine=engine,
-            download=SHOULD_DOWNLOAD_FROM_LICHESS,
-            parse=SHOULD_PARSE_DOWNLOADED_GAMES,
-            analysis_time=ENGINE_ANALYSIS_TIME,
-            game_filter=AND(
-                filter_if_not_rated_game(),
-                filter_if_anonymous_player(),
-                filter_if_played_against_ai(),
-                filter_if_variant_is_not_in('standard')
-            )
-        )
-    print("games saved, goodbye")
-    # local_data_manager.combine_berserk_and_analysis_data(userid=USER_ID, download=False, analysis_time=0.25)
+    if args.profile:
+        enable_profiling()
+    args.func(args)
+    METRICS.log_summary()
+    METRICS.write_json_lines(args.metrics_path)
+    if args.prometheus_path is not None:
+        METRICS.write_prometheus(args.prometheus_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+from typing import Dict, Iterator, Tuple, Union
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 25., 50., 100.)
+
+
+def _key(name: str, labels: Dict[str, str]) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.bucket_counts[i] += 1
+                break
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+            'buckets': dict(zip(self.buckets, self.bucket_counts))
+        }
+
+
+class MetricsRegistry:
+    """
+    counters and histograms by name and labels, safe to update from the engine and pipeline threads
+    ie: `METRICS.inc('bytes_downloaded_total', len(line))`, `METRICS.observe('engine_latency_seconds', 0.1)`
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[tuple, float] = {}
+        self._histograms: Dict[tuple, Histogram] = {}
+        self.started = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **labels):
+        """
+        :param buckets: only used by the first observation of a histogram
+        """
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            self._histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(_key(name, labels), 0)
+
+    def histogram(self, name: str, **labels) -> Union[Histogram, None]:
+        with self._lock:
+            return self._histograms.get(_key(name, labels))
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+            self.started = time.time()
+
+    def summary(self) -> dict:
+        """
+        the rates that tell whether a run is network, parse or engine bound
+        """
+        engine = self.histogram('engine_latency_seconds')
+        parse = self.histogram('parse_seconds')
+        engine_seconds = engine.sum if engine else 0.
+        hits, misses = self.counter('eval_cache_hits_total'), self.counter('eval_cache_misses_total')
+        return {
+            'elapsed_seconds': time.time() - self.started,
+            'download_seconds': self.counter('download_seconds_total'),
+            'bytes_downloaded': self.counter('bytes_downloaded_total'),
+            'parse_seconds': parse.sum if parse else 0.,
+            'engine_seconds': engine_seconds,
+            'positions_per_second': self.counter('engine_positions_total') / engine_seconds if engine_seconds else None,
+            'nodes_per_second': self.counter('engine_nodes_total') / engine_seconds if engine_seconds else None,
+            'cache_hit_rate': hits / (hits + misses) if hits + misses else None
+        }
+
+    def to_records(self) -> Iterator[dict]:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: histogram.to_dict() for key, histogram in self._histograms.items()}
+        for (name, labels), value in sorted(counters.items()):
+            yield {'type': 'counter', 'name': name, 'labels': dict(labels), 'value': value}
+        for (name, labels), histogram in sorted(histograms.items()):
+            yield {'type': 'histogram', 'name': name, 'labels': dict(labels), **histogram}
+
+    def write_json_lines(self, path: str):
+        """
+        appends one line per metric plus a summary line, all with the same timestamp
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        timestamp = time.time()
+        with open(path, 'a') as f:
+            for record in self.to_records():
+                f.write(json.dumps({'timestamp': timestamp, **record}) + '\n')
+            f.write(json.dumps({'timestamp': timestamp, 'type': 'summary', **self.summary()}) + '\n')
+
+    def write_prometheus(self, path: str):
+        """
+        prometheus text format, ie: for the node exporter's textfile collector
+        """
+        lines = []
+        typed = set()
+        for record in self.to_records():
+            name = record['name']
+            labels = record['labels']
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {record['type']}")
+            if record['type'] == 'counter':
+                lines.append(f"{name}{_format_labels(labels)} {record['value']}")
+                continue
+            cumulative = 0
+            for upper, count in record['buckets'].items():
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels({**labels, 'le': upper})} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {record['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {record['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels)} {record['count']}")
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        # the collector may read the file at any moment
+        os.replace(tmp_path, path)
+
+    def log_summary(self):
+        summary = self.summary()
+        logger.info("metrics: " + ", ".join(
+            f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}" for key, value in summary.items()
+        ))
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+METRICS = MetricsRegistry()
+
+
+def log_progress(stage: str, done: int, total: int, start: float, every: int = 10):
+    """
+    logs how far a stage is and its expected time left every `every` items
+    """
+    METRICS.inc('items_done_total', stage=stage)
+    if done % every != 0 or done == 0:
+        return
+    elapsed = time.time() - start
+    per_second = done / elapsed if elapsed else float('inf')
+    left = (total - done) / per_second if per_second else float('inf')
+    logger.info(f"{stage}: {done}/{total} ({done / total:.1%}) at {per_second:.2f}/sec, "
+                f"around {left / 60:.1f} minutes left")
+
+
+# opt-in profiling of every stage, see `enable_profiling`
+_profiling = {'cprofile': False, 'tracemalloc': False, 'output_dir': os.path.join('logs', 'profiles')}
+
+
+def enable_profiling(cprofile: bool = True, trace_memory: bool = False, output_dir: str = None):
+    """
+    :param cprofile: dumps each stage's profile to `output_dir/<stage>.prof`, open it with pstats or snakeviz
+    :param trace_memory: logs each stage's peak traced memory and its top allocating lines, this slows everything
+    """
+    _profiling['cprofile'] = cprofile
+    _profiling['tracemalloc'] = trace_memory
+    if output_dir is not None:
+        _profiling['output_dir'] = output_dir
+
+
+@contextmanager
+def profile_stage(stage: str) -> Iterator[None]:
+    """
+    times a stage into `stage_seconds` and profiles it when profiling is enabled
+    cProfile only sees the thread it was started in, so pipeline stages are profiled from their own thread
+    """
+    profiler = None
+    if _profiling['cprofile']:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is already running in this thread, ie: a stage inside a profiled stage
+            profiler = None
+    started_tracing = _profiling['tracemalloc'] and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    try:
+        with METRICS.timer('stage_seconds', stage=stage):
+            yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(_profiling['output_dir'], exist_ok=True)
+            profiler.dump_stats(os.path.join(_profiling['output_dir'], f'{stage}.prof'))
+        if started_tracing:
+            _, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:5]
+            tracemalloc.stop()
+            METRICS.observe('stage_peak_traced_bytes', peak, stage=stage)
+            logger.info(f"{stage} peaked at {peak / 2 ** 20:.1f} MB traced, top allocations:\n" +
+                        "\n".join(str(stat) for stat in top))
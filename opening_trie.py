@@ -0,0 +1,244 @@
+from typing import Dict, Iterable, Iterator, List, Set, Tuple, Union
+import logging
+
+import numpy as np
+import pandas as pd
+import chess
+import chess.pgn
+
+from analysis_utils import (get_all_losses_for_my_moves, get_first_move_with_bad_move, _get_color_following,
+                            ply_to_move_num)
+from game_record import GameRecord, unpack_move
+from game_store import get_game_id
+
+logger = logging.getLogger(__name__)
+
+# deep enough for the opening and the early middlegame, past it almost every position is only in one game
+DEFAULT_MAX_PLIES = 40
+_POINTS = {'1-0': (1., 0.), '0-1': (0., 1.), '1/2-1/2': (.5, .5)}
+
+
+class PositionStats:
+    """
+    what the followed player's games did from one position, whatever move order they reached it with
+    `ply` is the earliest ply the position was reached at, loss and first bad move are counted on the position the
+    followed player moved from, so they only add up on positions where it was their turn
+    """
+    __slots__ = ('epd', 'ply', 'games', 'scored_games', 'points', 'loss_sum', 'loss_count', 'inf_losses',
+                 'first_bad_moves', 'children', 'ids')
+
+    def __init__(self, epd: str, ply: int):
+        self.epd = epd
+        self.ply = ply
+        self.games = 0
+        self.scored_games = 0  # games with a result
+        self.points = 0.
+        self.loss_sum = 0.
+        self.loss_count = 0
+        self.inf_losses = 0  # mates missed or walked into, left out of the average loss
+        self.first_bad_moves = 0
+        self.children: Dict[str, str] = {}  # uci move -> epd of the position it leads to
+        self.ids: Union[List[str], None] = None
+
+    @property
+    def score(self) -> Union[float, None]:
+        return self.points / self.scored_games if self.scored_games else None
+
+    @property
+    def avg_loss(self) -> Union[float, None]:
+        return self.loss_sum / self.loss_count if self.loss_count else None
+
+    @property
+    def first_bad_move_rate(self) -> float:
+        return self.first_bad_moves / self.games if self.games else 0.
+
+    def board(self) -> chess.Board:
+        return chess.Board(self.epd + ' 0 1')
+
+    def __repr__(self):
+        return f"PositionStats({self.epd!r}, ply={self.ply}, games={self.games}, score={self.score}, " \
+               f"avg_loss={self.avg_loss}, first_bad_moves={self.first_bad_moves})"
+
+
+class OpeningTrie:
+    """
+    a player's games merged into one tree of positions, built once and then queried instead of scanning every game
+    positions are keyed by their epd so transpositions share a node, which makes it a DAG rather than a tree
+    ie: `trie = OpeningTrie.from_games(read_records(userid, analysis_time), userid)`
+        `trie.worst_positions(after_move=8, min_games=5)`
+    """
+    def __init__(self, player_to_follow: str, max_plies: Union[int, None] = DEFAULT_MAX_PLIES,
+                 min_rating=-float('inf'), max_rating=float('inf'), keep_ids: bool = False):
+        """
+        :param max_plies: positions past it aren't kept, None keeps whole games
+        :param min_rating: passed to get_first_move_with_bad_move, so is max_rating
+        :param keep_ids: keeps the ids of the games through every position, see `games_through`
+        """
+        self.player_to_follow = player_to_follow
+        self.max_plies = max_plies
+        self.min_rating = min_rating
+        self.max_rating = max_rating
+        self.keep_ids = keep_ids
+        self.nodes: Dict[str, PositionStats] = {}
+        self.root_epds: Set[str] = set()
+        self._ids: Set[str] = set()
+
+    @classmethod
+    def from_games(cls, games: Iterable[Union[chess.pgn.Game, GameRecord]], player_to_follow: str,
+                   **kwargs) -> 'OpeningTrie':
+        trie = cls(player_to_follow, **kwargs)
+        trie.add_games(games)
+        return trie
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, game_id: str) -> bool:
+        return game_id in self._ids
+
+    def add_games(self, games: Iterable[Union[chess.pgn.Game, GameRecord]]) -> int:
+        """
+        :return: number of games added, games already in the trie are skipped
+        """
+        return sum(self.add_game(game) for game in games)
+
+    def add_game(self, game: Union[chess.pgn.Game, GameRecord]) -> bool:
+        """
+        adds one more game to the stats of every position it went through
+        :return: False when the game was already added
+        """
+        game_id = get_game_id(game)
+        if game_id in self._ids:
+            return False
+        color_following = _get_color_following(game, self.player_to_follow)
+        points = _POINTS.get(game.headers.get('Result'))
+        losses = dict(get_all_losses_for_my_moves(game, self.player_to_follow))
+        first_bad_ply = self._first_bad_ply(game)
+
+        boards = _mainline_boards(game, self.max_plies)
+        previous = None
+        seen = set()
+        for ply, board, move in boards:
+            epd = board.epd()
+            node = self.nodes.get(epd)
+            if node is None:
+                node = self.nodes[epd] = PositionStats(epd, ply)
+            node.ply = min(node.ply, ply)
+            if previous is None:
+                self.root_epds.add(epd)
+            else:
+                previous.children[move.uci()] = epd
+                # the move out of the previous position was the followed player's when it lost eval
+                loss = losses.get(ply)
+                if loss is not None:
+                    if np.isinf(loss):
+                        previous.inf_losses += 1
+                    else:
+                        previous.loss_sum += loss
+                        previous.loss_count += 1
+                if ply == first_bad_ply:
+                    previous.first_bad_moves += 1
+            # a position repeated within the game still counts the game once
+            if epd not in seen:
+                seen.add(epd)
+                node.games += 1
+                if points is not None:
+                    node.scored_games += 1
+                    node.points += points[0] if color_following == chess.WHITE else points[1]
+                if self.keep_ids:
+                    if node.ids is None:
+                        node.ids = []
+                    node.ids.append(game_id)
+            previous = node
+        self._ids.add(game_id)
+        return True
+
+    def _first_bad_ply(self, game: Union[chess.pgn.Game, GameRecord]) -> Union[int, None]:
+        ply, loss = get_first_move_with_bad_move(game, self.player_to_follow, self.min_rating, self.max_rating)
+        num_plies = game.num_plies if isinstance(game, GameRecord) else sum(1 for _ in game.mainline())
+        if loss is None or (loss == 0.0 and ply == num_plies):
+            # a missing eval, or the game ended without a bad move
+            return None
+        return ply
+
+    def get(self, position: Union[chess.Board, str]) -> Union[PositionStats, None]:
+        """
+        :param position: a board or its epd
+        """
+        return self.nodes.get(position.epd() if isinstance(position, chess.Board) else position)
+
+    def children(self, position: Union[chess.Board, str]) -> List[Tuple[str, PositionStats]]:
+        """
+        (uci move, stats of the position it leads to) of every move played from the position, most played first
+        """
+        node = self.get(position)
+        if node is None:
+            return []
+        return sorted(((move, self.nodes[epd]) for move, epd in node.children.items()),
+                      key=lambda child: child[1].games, reverse=True)
+
+    def games_through(self, position: Union[chess.Board, str]) -> List[str]:
+        """
+        ids of the games that reached the position, needs keep_ids
+        """
+        if not self.keep_ids:
+            raise ValueError("the trie was built without keep_ids")
+        node = self.get(position)
+        return list(node.ids or []) if node is not None else []
+
+    def iter_nodes(self, min_ply: int = 0, max_ply: int = None, min_games: int = 1) -> Iterator[PositionStats]:
+        for node in self.nodes.values():
+            if node.games >= min_games and node.ply >= min_ply and (max_ply is None or node.ply <= max_ply):
+                yield node
+
+    def to_frame(self, min_ply: int = 0, max_ply: int = None, min_games: int = 1) -> pd.DataFrame:
+        """
+        one row per position, with the same move numbering as the notebook
+        """
+        nodes = list(self.iter_nodes(min_ply, max_ply, min_games))
+        return pd.DataFrame({
+            'epd': [node.epd for node in nodes],
+            'ply': [node.ply for node in nodes],
+            'move_num': [ply_to_move_num(node.ply) for node in nodes],
+            'games': [node.games for node in nodes],
+            'score': [node.score for node in nodes],
+            'avg_loss': [node.avg_loss for node in nodes],
+            'moves_with_loss': [node.loss_count for node in nodes],
+            'inf_losses': [node.inf_losses for node in nodes],
+            'first_bad_moves': [node.first_bad_moves for node in nodes],
+            'first_bad_move_rate': [node.first_bad_move_rate for node in nodes],
+        }, columns=['epd', 'ply', 'move_num', 'games', 'score', 'avg_loss', 'moves_with_loss', 'inf_losses',
+                    'first_bad_moves', 'first_bad_move_rate']).astype({'score': float, 'avg_loss': float})
+
+    def worst_positions(self, after_move: int = 0, min_games: int = 5, by: str = 'score', n: int = 10,
+                        before_move: int = None) -> pd.DataFrame:
+        """
+        the n positions the followed player did worst from, ie: `worst_positions(after_move=8, by='avg_loss')`
+        :param after_move: only positions after this move number, moves numbered like `ply_to_move_num`
+        :param by: 'score' (lowest first), 'avg_loss' or 'first_bad_move_rate' (highest first)
+        """
+        min_ply = 2 * after_move + 1
+        max_ply = 2 * before_move if before_move is not None else None
+        positions = self.to_frame(min_ply, max_ply, min_games)
+        if by == 'score':
+            positions = positions.dropna(subset=['score'])
+        return positions.sort_values(by, ascending=by == 'score', na_position='last').head(n).reset_index(drop=True)
+
+
+def _mainline_boards(game: Union[chess.pgn.Game, GameRecord],
+                     max_plies: Union[int, None]) -> Iterator[Tuple[int, chess.Board, Union[chess.Move, None]]]:
+    # (ply, board after it, move played), ply 0 being the starting position, the board is the same object every time
+    if isinstance(game, GameRecord):
+        board = game.starting_board()
+        moves = (unpack_move(int(packed)) for packed in game.moves) if game.moves is not None else None
+        if moves is None:
+            raise ValueError(f"{game.headers.get('ID')} was read without its moves")
+    else:
+        board = game.board()
+        moves = (node.move for node in game.mainline())
+    yield 0, board, None
+    for ply, move in enumerate(moves, start=1):
+        if max_plies is not None and ply > max_plies:
+            return
+        board.push(move)
+        yield ply, board, move
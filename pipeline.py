@@ -0,0 +1,115 @@
+from typing import Callable, Iterable, List, Any
+import logging
+import queue
+import threading
+
+from metrics import METRICS, profile_stage
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class _Stopped(Exception):
+    pass
+
+
+def _put(q: queue.Queue, item, stop: threading.Event):
+    # a bounded put that gives up once another stage failed, so no thread blocks forever on a full queue
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+
+def run_pipeline(source: Iterable, stages: List[Callable[[Any], Any]], sink: Callable[[Any], None],
+                 queue_size: int = 8) -> int:
+    """
+    every item from source flows through the stages in order and then into sink
+    each stage runs in its own thread with a bounded queue before it, so at most around queue_size items
+    per stage are in memory and a slow stage (ie: the engine) doesn't stop the faster ones before it
+    a stage returning None drops the item
+    :return: number of items that reached the sink
+    """
+    stop = threading.Event()
+    errors = []
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+    def run_source():
+        iterator = iter(source)
+        try:
+            for item in iterator:
+                _put(queues[0], item, stop)
+            _put(queues[0], _DONE, stop)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            logger.exception("pipeline source failed")
+            errors.append(e)
+            stop.set()
+        finally:
+            # lets a generator source clean up (ie: close its files) from this thread when the pipeline stops early
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    def run_stage(stage, inbox, outbox):
+        name = getattr(stage, '__name__', str(stage))
+        try:
+            with profile_stage(name):
+                while True:
+                    item = _get(inbox, stop)
+                    if item is _DONE:
+                        _put(outbox, _DONE, stop)
+                        return
+                    with METRICS.timer('pipeline_item_seconds', stage=name):
+                        result = stage(item)
+                    if result is not None:
+                        _put(outbox, result, stop)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            logger.exception(f"pipeline stage {name} failed")
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=run_source, name="pipeline-source", daemon=True)]
+    for i, stage in enumerate(stages):
+        threads.append(threading.Thread(
+            target=run_stage, args=(stage, queues[i], queues[i + 1]),
+            name=f"pipeline-{getattr(stage, '__name__', i)}", daemon=True
+        ))
+    for thread in threads:
+        thread.start()
+    num_items = 0
+    try:
+        while True:
+            item = _get(queues[-1], stop)
+            if item is _DONE:
+                break
+            sink(item)
+            num_items += 1
+    except _Stopped:
+        pass
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return num_items
@@ -0,0 +1,235 @@
+from typing import Dict, Iterable, List, Tuple, Union
+import io
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import chess
+import chess.pgn
+
+from game_record import RecordVisitor
+from game_store import GameStore, pgn_hash
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = '_manifest.json'  # pyarrow skips files starting with an underscore when reading the dataset
+COMPRESSION = 'zstd'
+# the headers copied onto every row, repeated values cost next to nothing once dictionary encoded
+HEADER_COLUMNS = ('White', 'Black', 'Result', 'UTCDate', 'Speed', 'Perf', 'TimeControl', 'ECO', 'Opening',
+                  'Status', 'AnalysisTime')
+ELO_COLUMNS = ('WhiteElo', 'BlackElo')
+
+_dict_string = pa.dictionary(pa.int32(), pa.string())
+PLY_SCHEMA = pa.schema(
+    [
+        ('id', _dict_string),
+        ('ply', pa.int16()),
+        ('move_num', pa.int16()),
+        ('side', _dict_string),  # who played the move, 'white' or 'black'
+        ('san', _dict_string),
+        ('eval', pa.int32()),  # white's point of view after the move, centipawns or moves to mate, null when missing
+        ('is_mate', pa.bool_()),
+        ('clock', pa.float32()),  # seconds left after the move
+    ]
+    + [(name, pa.int16()) for name in ELO_COLUMNS]
+    + [(name, _dict_string) for name in HEADER_COLUMNS]
+)
+
+
+class _SanRecordVisitor(RecordVisitor):
+    # keeps the san as written in the pgn, instead of writing it again from the board for every move
+    def begin_game(self):
+        super().begin_game()
+        self.sans: List[str] = []
+
+    def parse_san(self, board: chess.Board, san: str) -> chess.Move:
+        self.sans.append(san)
+        return super().parse_san(board, san)
+
+    def result(self):
+        return super().result(), self.sans
+
+
+def _to_int(value: Union[str, None]) -> Union[int, None]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None  # ie: "?" for an unknown rating
+
+
+def pgn_to_columns(pgn: str) -> Dict[str, list]:
+    """
+    one entry per ply of the game's mainline for every column of PLY_SCHEMA
+    """
+    record, sans = chess.pgn.read_game(io.StringIO(pgn), Visitor=_SanRecordVisitor)
+    num_plies = record.num_plies
+    plies = np.arange(1, num_plies + 1)
+    first_white = record.starting_board().turn == chess.WHITE
+    white_moved = (plies % 2 == 1) == first_white
+    clocks = record.clocks[1:]
+    headers = record.headers
+    columns = {
+        'id': [headers.get('ID')] * num_plies,
+        'ply': plies.tolist(),
+        'move_num': ((plies + 1) // 2).tolist(),
+        'side': np.where(white_moved, 'white', 'black').tolist(),
+        'san': sans[:num_plies],
+        'eval': np.where(record.has_eval[1:], record.evals[1:], None).tolist(),
+        'is_mate': record.is_mate[1:].tolist(),
+        'clock': np.where(np.isnan(clocks), None, clocks).tolist(),
+    }
+    for name in ELO_COLUMNS:
+        columns[name] = [_to_int(headers.get(name))] * num_plies
+    for name in HEADER_COLUMNS:
+        columns[name] = [headers.get(name)] * num_plies
+    return columns
+
+
+def pgns_to_table(pgns: Iterable[str]) -> pa.Table:
+    columns: Dict[str, list] = {field.name: [] for field in PLY_SCHEMA}
+    for pgn in pgns:
+        for name, values in pgn_to_columns(pgn).items():
+            columns[name].extend(values)
+    return pa.table({field.name: pa.array(columns[field.name], type=field.type) for field in PLY_SCHEMA},
+                    schema=PLY_SCHEMA)
+
+
+class PlyDataset:
+    """
+    every ply of a GameStore's games in a directory of parquet part files, one row per ply, sorted by game and ply
+    each update only exports the games that are new or changed since the last one into a new part file,
+    and the parts get merged back into one once there are more than max_parts
+    ie: `PlyDataset(path).read(columns=['id', 'ply', 'eval'], filters=[('Speed', '=', 'blitz')])`
+    """
+    def __init__(self, path: str, max_parts: int = 16):
+        self.path = path
+        self.manifest_path = os.path.join(path, MANIFEST_NAME)
+        self.max_parts = max_parts
+        # game id -> [pgn hash, part file]
+        self._games: Dict[str, List[str]] = {}
+        self._next_part = 0
+        self._load_manifest()
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            self._games = manifest['games']
+            self._next_part = manifest['next_part']
+        for part in set(self._part_files()) - set(self.parts()):
+            # written by an update that died before saving the manifest
+            logger.warning(f"removing {part} from {self.path}, it isn't in the manifest")
+            os.remove(os.path.join(self.path, part))
+
+    def _save_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'games': self._games, 'next_part': self._next_part}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _part_files(self) -> List[str]:
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.parquet'))
+
+    def parts(self) -> List[str]:
+        return sorted({part for _, part in self._games.values()})
+
+    def __len__(self):
+        """
+        number of games
+        """
+        return len(self._games)
+
+    def _write_part(self, table: pa.Table, part: str):
+        tmp_path = os.path.join(self.path, part + '.tmp')
+        # sorted so each row group covers a narrow range of ids, arrow can't sort dictionary columns directly
+        order = pc.sort_indices(pa.table({'id': table['id'].cast(pa.string()), 'ply': table['ply']}),
+                                sort_keys=[('id', 'ascending'), ('ply', 'ascending')])
+        pq.write_table(table.take(order), tmp_path, compression=COMPRESSION, use_dictionary=True,
+                       row_group_size=128 * 1024)
+        os.replace(tmp_path, os.path.join(self.path, part))
+
+    def _new_part_name(self) -> str:
+        part = f'part-{self._next_part:05d}.parquet'
+        self._next_part += 1
+        return part
+
+    def update(self, store: GameStore) -> int:
+        """
+        exports the games of store that are new or changed, and drops the rows of games no longer in it
+        what changed is found from the store's index, only the pgns of those games are read
+        :return: number of games exported
+        """
+        os.makedirs(self.path, exist_ok=True)
+        changed: List[Tuple[str, str]] = []
+        pgns: List[str] = []
+        store_ids = store.ids()
+        for game_id in store_ids:
+            game_hash = store.entry(game_id).get('pgn_hash')
+            pgn = None
+            if game_hash is None:
+                # indexes written before they kept the hash
+                pgn = store.read_pgn(game_id)
+                game_hash = pgn_hash(pgn)
+            if game_id not in self._games or self._games[game_id][0] != game_hash:
+                changed.append((game_id, game_hash))
+                pgns.append(pgn if pgn is not None else store.read_pgn(game_id))
+        removed = set(self._games) - set(store_ids)
+        stale = {game_id for game_id, _ in changed if game_id in self._games} | removed
+        if not changed and not removed:
+            return 0
+
+        # parts holding an old version of a game are written again without it
+        stale_parts = {self._games[game_id][1] for game_id in stale}
+        for part in stale_parts:
+            table = pq.read_table(os.path.join(self.path, part))
+            keep = pc.invert(pc.is_in(table['id'].cast(pa.string()), value_set=pa.array(sorted(stale))))
+            self._write_part(table.filter(keep), part)
+        for game_id in removed:
+            del self._games[game_id]
+
+        if changed:
+            part = self._new_part_name()
+            self._write_part(pgns_to_table(pgns), part)
+            for game_id, pgn_hash in changed:
+                self._games[game_id] = [pgn_hash, part]
+        self._save_manifest()
+        for part in set(self._part_files()) - set(self.parts()):
+            os.remove(os.path.join(self.path, part))
+        logger.info(f"exported the plies of {len(changed)} games to {self.path}, {len(self._games)} games in total")
+        if len(self.parts()) > self.max_parts:
+            self.compact()
+        return len(changed)
+
+    def compact(self):
+        """
+        merges every part into one
+        """
+        old_parts = self.parts()
+        part = self._new_part_name()
+        self._write_part(self.read_table(), part)
+        for game_id in self._games:
+            self._games[game_id][1] = part
+        self._save_manifest()
+        for old_part in old_parts:
+            os.remove(os.path.join(self.path, old_part))
+
+    def read_table(self, columns: List[str] = None, filters=None) -> pa.Table:
+        """
+        :param filters: pushed down to skip the row groups that can't match, ie: [('move_num', '>', 8)]
+        """
+        if not self._games:
+            return PLY_SCHEMA.empty_table() if columns is None else PLY_SCHEMA.empty_table().select(columns)
+        return pq.read_table(self.path, columns=columns, filters=filters, memory_map=True, schema=PLY_SCHEMA)
+
+    def read(self, columns: List[str] = None, filters=None) -> pd.DataFrame:
+        """
+        as a DataFrame, the dictionary encoded columns become categoricals
+        """
+        return self.read_table(columns=columns, filters=filters).to_pandas()
@@ -0,0 +1,287 @@
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+import argparse
+import io
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+import chess.engine
+import chess.pgn
+
+import add_chess_analysis
+from eval_cache import EvalCache
+from logging_config import init_logger
+
+logger = logging.getLogger(__name__)
+
+DATA_FOLDER = 'data'
+DEFAULT_QUEUE_NAME = 'work_queue.sqlite'
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def get_default_queue_path():
+    return os.path.join(DATA_FOLDER, DEFAULT_QUEUE_NAME)
+
+
+def get_analysis_job(userid, analysis_time) -> str:
+    return f"{userid}/{analysis_time}"
+
+
+class WorkQueue:
+    """
+    durable queue of tasks in a sqlite file, that file can live on storage shared by several machines
+    a worker leases tasks for `lease_seconds`, a task whose lease runs out (ie: the worker died) goes back to
+    the other workers, until it was tried `max_attempts` times
+    leases use the clock of each machine, so keep the clocks of the workers in sync
+    """
+    def __init__(self, path: str = None, max_attempts: int = 3, timeout: float = 60.):
+        self.path = path or get_default_queue_path()
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # the default rollback journal instead of WAL, WAL needs shared memory that network file systems don't have
+        self._conn = sqlite3.connect(self.path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "job TEXT NOT NULL, task_id TEXT NOT NULL, payload TEXT NOT NULL, state TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, owner TEXT, lease_expires REAL, result TEXT, error TEXT, "
+            "PRIMARY KEY (job, task_id))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (job, state)")
+
+    def _transaction(self, fn):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers never claim the same task
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def enqueue(self, job: str, tasks: Iterable[Tuple[str, str]]) -> int:
+        """
+        :param tasks: (task_id, payload), tasks already in the job are left as they are
+        :return: number of new tasks
+        """
+        def insert(conn):
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks (job, task_id, payload, state) VALUES (?, ?, ?, ?)",
+                ((job, task_id, payload, PENDING) for task_id, payload in tasks)
+            )
+            return conn.total_changes - before
+        return self._transaction(insert)
+
+    def claim(self, job: str, owner: str, lease_seconds: float, limit: int = 1) -> List[Tuple[str, str]]:
+        """
+        leases up to `limit` pending tasks, or tasks whose lease expired
+        :return: (task_id, payload) of the leased tasks
+        """
+        def claim_tasks(conn):
+            now = time.time()
+            rows = conn.execute(
+                "SELECT task_id, payload FROM tasks WHERE job = ? AND "
+                "(state = ? OR (state = ? AND lease_expires < ?)) AND attempts < ? LIMIT ?",
+                (job, PENDING, LEASED, now, self.max_attempts, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE tasks SET state = ?, owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE job = ? AND task_id = ?",
+                ((LEASED, owner, now + lease_seconds, job, task_id) for task_id, _ in rows)
+            )
+            # expired leases that were already tried max_attempts times won't be claimed again
+            conn.execute(
+                "UPDATE tasks SET state = ?, error = 'lease expired' WHERE job = ? AND state = ? "
+                "AND lease_expires < ? AND attempts >= ?",
+                (FAILED, job, LEASED, now, self.max_attempts)
+            )
+            return rows
+        return self._transaction(claim_tasks)
+
+    def renew(self, job: str, owner: str, task_ids: Iterable[str], lease_seconds: float):
+        def renew_tasks(conn):
+            conn.executemany(
+                "UPDATE tasks SET lease_expires = ? WHERE job = ? AND task_id = ? AND owner = ? AND state = ?",
+                ((time.time() + lease_seconds, job, task_id, owner, LEASED) for task_id in task_ids)
+            )
+        self._transaction(renew_tasks)
+
+    def complete(self, job: str, owner: str, task_id: str, result: str) -> bool:
+        """
+        :return: False when the lease was lost to another worker, the result is then dropped
+        """
+        def complete_task(conn):
+            cursor = conn.execute(
+                "UPDATE tasks SET state = ?, result = ?, lease_expires = NULL WHERE job = ? AND task_id = ? "
+                "AND owner = ? AND state = ?",
+                (DONE, result, job, task_id, owner, LEASED)
+            )
+            return cursor.rowcount == 1
+        return self._transaction(complete_task)
+
+    def fail(self, job: str, owner: str, task_id: str, error: str):
+        """
+        gives the task back to be retried, or marks it failed once it was tried max_attempts times
+        """
+        def fail_task(conn):
+            conn.execute(
+                "UPDATE tasks SET state = CASE WHEN attempts < ? THEN ? ELSE ? END, error = ?, lease_expires = NULL "
+                "WHERE job = ? AND task_id = ? AND owner = ? AND state = ?",
+                (self.max_attempts, PENDING, FAILED, error, job, task_id, owner, LEASED)
+            )
+        self._transaction(fail_task)
+
+    def counts(self, job: str) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM tasks WHERE job = ? GROUP BY state", (job,))
+            counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+            counts.update(dict(rows.fetchall()))
+            return counts
+
+    def is_finished(self, job: str) -> bool:
+        counts = self.counts(job)
+        return counts[PENDING] == 0 and counts[LEASED] == 0
+
+    def results(self, job: str) -> Iterator[Tuple[str, str]]:
+        """
+        (task_id, result) of every done task
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT task_id, result FROM tasks WHERE job = ? AND state = ?", (job, DONE)
+            ).fetchall()
+        yield from rows
+
+    def failures(self, job: str) -> List[Tuple[str, str]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT task_id, error FROM tasks WHERE job = ? AND state = ?", (job, FAILED)
+            ).fetchall()
+
+    def delete(self, job: str):
+        self._transaction(lambda conn: conn.execute("DELETE FROM tasks WHERE job = ?", (job,)))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _LeaseKeeper:
+    # renews the leases of the tasks being worked on, so a slow game isn't handed to another worker
+    def __init__(self, work_queue: WorkQueue, job: str, owner: str, lease_seconds: float):
+        self.work_queue = work_queue
+        self.job = job
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.task_ids: List[str] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='lease-keeper', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            task_ids = list(self.task_ids)
+            if task_ids:
+                try:
+                    self.work_queue.renew(self.job, self.owner, task_ids, self.lease_seconds)
+                except sqlite3.Error:
+                    logger.exception("failed renewing leases, they may go to another worker")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_analysis_worker(job: str, engine_path: Union[str, List[str]], analysis_time: float,
+                        queue_path: str = None, engine_options: dict = None, lease_seconds: float = 300,
+                        batch_size: int = 1, poll_seconds: float = 5, wait_for_work: bool = False,
+                        eval_cache: EvalCache = None,
+                        schedule: add_chess_analysis.GameOrderedSchedule = None) -> int:
+    """
+    analyses the games of `job` until there are none left, start one per engine on as many machines as there are
+    the engine is only started once there is work
+    :param wait_for_work: keep polling for new tasks instead of stopping once the job is finished
+    :return: number of games this worker analysed
+    """
+    owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    num_done = 0
+    engine = None
+    with WorkQueue(queue_path) as work_queue, _LeaseKeeper(work_queue, job, owner, lease_seconds) as lease_keeper:
+        try:
+            while True:
+                tasks = work_queue.claim(job, owner, lease_seconds, limit=batch_size)
+                if not tasks:
+                    if not wait_for_work and work_queue.is_finished(job):
+                        break
+                    # other workers still hold leases, one of them may die and leave its task
+                    time.sleep(poll_seconds)
+                    continue
+                if engine is None:
+                    engine = add_chess_analysis.LazyEngine(engine_path, engine_options)
+                lease_keeper.task_ids = [task_id for task_id, _ in tasks]
+                for task_id, pgn in tasks:
+                    try:
+                        game = chess.pgn.read_game(io.StringIO(pgn))
+                        game = add_chess_analysis.add_eval_to_game(game, engine, analysis_time, cache=eval_cache,
+                                                                   schedule=schedule)
+                    except (chess.engine.EngineError, chess.engine.EngineTerminatedError, ValueError) as e:
+                        logger.exception(f"failed analysing {task_id}")
+                        work_queue.fail(job, owner, task_id, repr(e))
+                        if isinstance(e, chess.engine.EngineTerminatedError):
+                            # closes what is left of the dead process, the next game starts a new one
+                            engine.quit()
+                        continue
+                    if work_queue.complete(job, owner, task_id, str(game)):
+                        num_done += 1
+                    else:
+                        logger.warning(f"lost the lease on {task_id}, another worker analyses it")
+                lease_keeper.task_ids = []
+                logger.info(f"{owner} analysed {num_done} games, {work_queue.counts(job)}")
+        finally:
+            if engine is not None:
+                engine.quit()
+    return num_done
+
+
+if __name__ == '__main__':
+    init_logger()
+    parser = argparse.ArgumentParser(description="analyses games from a shared work queue")
+    parser.add_argument('job', help="ie: chessprimes/0.25, see local_data_manager.enqueue_analysis")
+    parser.add_argument('--analysis-time', type=float, required=True)
+    parser.add_argument('--queue', default=None, help="path to the queue's sqlite file")
+    parser.add_argument('--lease-seconds', type=float, default=300)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--wait', action='store_true', help="keep waiting for new games once the job is done")
+    # the same engine settings as `main.py analyze`, so every worker analyses like it would
+    from main import add_engine_arguments, get_engine_settings
+    add_engine_arguments(parser)
+    args = parser.parse_args()
+    engine_path, engine_options, eval_cache, schedule = get_engine_settings(args)
+    try:
+        run_analysis_worker(args.job, engine_path, args.analysis_time, queue_path=args.queue,
+                            engine_options=engine_options, lease_seconds=args.lease_seconds,
+                            batch_size=args.batch_size, wait_for_work=args.wait, eval_cache=eval_cache,
+                            schedule=schedule)
+    finally:
+        if eval_cache is not None:
+            eval_cache.close()